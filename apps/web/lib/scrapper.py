@@ -12,14 +12,42 @@ Usage:
   python scrape_elminassa_v2.py --output scraped-elminassa.json
   python scrape_elminassa_v2.py --url "https://www.elminassa.com/app.html?v=20250405" --scroll 80 --max 2000
   python scrape_elminassa_v2.py --debug
+  python scrape_elminassa_v2.py --changes changes.ndjson
+  python scrape_elminassa_v2.py --parquet listings-parquet   # needs: pip install pyarrow
+  python scrape_elminassa_v2.py --verify-media --thumbs thumbs    # thumbnails need: pip install pillow
+  python scrape_elminassa_v2.py --thumbs thumbs --thumbs-base-url https://cdn.example.com/thumbs   # sync thumbs/ there
+  python scrape_elminassa_v2.py --learn-endpoints   # record which API endpoints carry listings
+  python scrape_elminassa_v2.py --lookup 5bc222ac6b49ac4d1e2261e6   # read one ad from --output
+  python scrape_elminassa_v2.py --history listing-history   # then: --history listing-history --history-of <id>
+  python scrape_elminassa_v2.py --search-index search-index   # then: --search-index search-index --search "terrain tevragh"
+  python scrape_elminassa_v2.py --daemon --every 60  # warm browser; curl -X POST localhost:8765/crawl
 """
 
 import argparse
 import asyncio
+import bisect
+import hashlib
+import heapq
+import importlib.util
+import itertools
 import json
+import math
+import mmap
+import os
 import re
-from dataclasses import dataclass, asdict
-from typing import Any, Dict, List, Optional, Tuple
+import struct
+import time
+import unicodedata
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict, field, fields
+from datetime import datetime, timezone
+from http import HTTPStatus
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
 
 # Install playwright and its browsers
 !pip install playwright
@@ -42,12 +70,40 @@ def parse_args() -> argparse.Namespace:
     p.add_argument("--output", default="scraped-elminassa-data.json")
     p.add_argument("--max", type=int, default=1500)
     p.add_argument("--scroll", type=int, default=60)
+    p.add_argument("--stall", type=int, default=4, help="Hard stop after this many no-growth steps")
     p.add_argument("--debug", action="store_true")
     p.add_argument("--headful", action="store_true")
     p.add_argument("--no-details", action="store_true", help="Disable hydration from adDetails/<id>")
     p.add_argument("--concurrency", type=int, default=6)
+    p.add_argument("--deadline", type=float, default=0, help="Hydration time budget per crawl in seconds; unhydrated ads roll over to the next run (0 = none)")
+    p.add_argument("--geom-tolerance", type=float, default=0.5, help="subPolygon simplification tolerance in metres (0 = only clean)")
+    p.add_argument("--changes", default=None, help="Write NDJSON diff vs the previous --output snapshot to this path")
+    p.add_argument("--parquet", default=None, help="Also export to Parquet under this dir (partitioned by scrape_date/region)")
+    p.add_argument("--verify-media", action="store_true", help="HEAD-check photo/video URLs and drop dead ones")
+    p.add_argument("--thumbs", default=None, help="Generate cached photo thumbnails in this dir (implies --verify-media)")
+    p.add_argument("--thumbs-base-url", default=None, help="Public URL the --thumbs dir is served/uploaded at; stored in thumbnails instead of local paths")
+    p.add_argument("--media-concurrency", type=int, default=32)
+    p.add_argument("--no-block", action="store_true", help="Let the browser download images/fonts/media/map tiles")
+    p.add_argument("--endpoints", default="listing-endpoints.json", help="Known listing endpoints (read, and written by --learn-endpoints)")
+    p.add_argument("--learn-endpoints", action="store_true", help="Buffer every XHR and record endpoints that yield listings")
+    p.add_argument("--history", default=None, help="Append price/visit history of each run to this dir")
+    p.add_argument("--history-of", default=None, metavar="ID", help="Print one listing's history from --history and exit")
+    p.add_argument("--search-index", default=None, help="Maintain a full-text index of titles/descriptions in this dir")
+    p.add_argument("--search", default=None, metavar="QUERY", help="Query --search-index (AND of terms, 'terr*' prefixes) and exit")
+    p.add_argument("--lookup", nargs="+", default=None, metavar="ID", help="Print these listings from --output (via its .idx) and exit")
+    p.add_argument("--daemon", action="store_true", help="Stay running with a warm browser; crawl on --every or via --control")
+    p.add_argument("--control", default="127.0.0.1:8765", help="Daemon control API: host:port or unix:/path/to.sock")
+    p.add_argument("--every", type=float, default=0, help="Daemon crawl interval in minutes (0 = on demand only)")
+    p.add_argument("--warm-max-age", type=float, default=300, help="Reload the warm page if it loaded longer ago than this (s)")
+    p.add_argument("--recycle-mb", type=float, default=1500, help="Relaunch the browser when its processes exceed this RSS")
+    p.add_argument("--recycle-crawls", type=int, default=50, help="Relaunch the browser after this many crawls")
     # Use parse_known_args to ignore arguments passed by the Colab kernel
     args, unknown = p.parse_known_args()
+    # fail before crawling, not after
+    if args.parquet and importlib.util.find_spec("pyarrow") is None:
+        p.error("--parquet requires pyarrow (pip install pyarrow)")
+    if args.thumbs and importlib.util.find_spec("PIL") is None:
+        p.error("--thumbs requires Pillow (pip install pillow)")
     return args
 
 
@@ -212,6 +268,16 @@ class ScrapedListing:
     elevation: Optional[str] = None
     sidesLength: Optional[str] = None
     matterportLink: Optional[str] = None
+    thumbnails: List[str] = field(default_factory=list)  # --thumbs-base-url URLs, else local cache paths (media stage)
+    subPolygonEncoded: List[str] = field(default_factory=list)  # polyline per ring, filled by the geometry stage
+
+
+def raw_visit_count(item: Dict[str, Any]) -> int:
+    v = item.get("visitCount") or item.get("visit_count") or item.get("views") or 0
+    try:
+        return int(v)
+    except Exception:
+        return 0
 
 
 def to_scraped_listing(item: Dict[str, Any]) -> ScrapedListing:
@@ -251,12 +317,6 @@ def to_scraped_listing(item: Dict[str, Any]) -> ScrapedListing:
         "email": pub.get("email") if pub.get("email") else None,
     }
 
-    visit_count = item.get("visitCount") or item.get("visit_count") or item.get("views") or 0
-    try:
-        visit_count = int(visit_count)
-    except Exception:
-        visit_count = 0
-
     lot = item.get("lot")
     if isinstance(lot, list):
         lot_list = [str(x) for x in lot]
@@ -273,7 +333,7 @@ def to_scraped_listing(item: Dict[str, Any]) -> ScrapedListing:
         deleted=bool(item.get("deleted", False)),
         tobedeleted=bool(item.get("tobedeleted", False)),
         visible=item.get("visible", True) is not False,
-        visitCount=visit_count,
+        visitCount=raw_visit_count(item),
         lot=lot_list,
         isRealLocation=is_real_loc and (item.get("isRealLocation", True) is not False) and (item.get("is_real_location", True) is not False),
         subPolygon=item.get("subPolygon") or item.get("sub_polygon") or [],
@@ -301,6 +361,1097 @@ def to_scraped_listing(item: Dict[str, Any]) -> ScrapedListing:
     )
 
 
+# -----------------------------
+# Geometry (subPolygon cleanup, simplification, compact encoding)
+# -----------------------------
+GEOM_DECIMALS = 7  # ~1 cm
+POLYLINE_PRECISION = 6
+
+
+def is_point(p: Any) -> bool:
+    return (
+        isinstance(p, (list, tuple)) and len(p) >= 2 and
+        all(isinstance(v, (int, float)) and not isinstance(v, bool) and math.isfinite(v) for v in p[:2])
+    )
+
+
+def clean_ring(ring: Any) -> List[List[float]]:
+    """
+    Drops invalid and repeated vertices (e.g. a ring concatenated onto itself by
+    payload merges), fixes swapped [lat, lng] pairs and closes the ring.
+    Returns [] when fewer than 3 distinct vertices remain.
+    """
+    if not isinstance(ring, list):
+        return []
+    out: List[List[float]] = []
+    seen = set()
+    for p in ring:
+        if not is_point(p):
+            continue
+        coords, _ = extract_coordinates({"coordinates": [p[0], p[1]]})
+        if coords is None:
+            continue
+        pt = (round(coords[0], GEOM_DECIMALS), round(coords[1], GEOM_DECIMALS))
+        if pt in seen:
+            continue
+        seen.add(pt)
+        out.append([pt[0], pt[1]])
+    if len(out) < 3:
+        return []
+    out.append(list(out[0]))
+    return out
+
+
+def simplify_ring(ring: List[List[float]], tolerance_m: float) -> List[List[float]]:
+    """Douglas-Peucker on a closed ring, in metres (local equirectangular projection)."""
+    if tolerance_m <= 0 or len(ring) <= 5:
+        return ring
+    lat0 = math.radians(sum(p[1] for p in ring) / len(ring))
+    kx, ky = 111320.0 * math.cos(lat0), 110540.0
+    xy = [(p[0] * kx, p[1] * ky) for p in ring]
+
+    def seg_dist(i: int, a: int, b: int) -> float:
+        (px, py), (ax, ay), (bx, by) = xy[i], xy[a], xy[b]
+        dx, dy = bx - ax, by - ay
+        if dx == 0 and dy == 0:
+            return math.hypot(px - ax, py - ay)
+        t = max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / (dx * dx + dy * dy)))
+        return math.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+    last = len(ring) - 1
+    # split the closed ring at the vertex farthest from the start
+    far = max(range(1, last), key=lambda i: math.hypot(xy[i][0] - xy[0][0], xy[i][1] - xy[0][1]))
+    keep = [False] * len(ring)
+    keep[0] = keep[far] = keep[last] = True
+    stack = [(0, far), (far, last)]
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+        idx, dmax = max(((i, seg_dist(i, a, b)) for i in range(a + 1, b)), key=lambda t: t[1])
+        if dmax > tolerance_m:
+            keep[idx] = True
+            stack.append((a, idx))
+            stack.append((idx, b))
+
+    out = [p for p, k in zip(ring, keep) if k]
+    return out if len(out) >= 4 else ring
+
+
+def encode_polyline(ring: List[List[float]], precision: int = POLYLINE_PRECISION) -> str:
+    """Google encoded polyline of [lng, lat] points (emitted in lat,lng order, as the format expects)."""
+    factor = 10 ** precision
+    out: List[str] = []
+    prev_lat = prev_lng = 0
+    for lng, lat in ring:
+        ilat, ilng = int(round(lat * factor)), int(round(lng * factor))
+        for delta in (ilat - prev_lat, ilng - prev_lng):
+            v = ~(delta << 1) if delta < 0 else delta << 1
+            while v >= 0x20:
+                out.append(chr((0x20 | (v & 0x1F)) + 63))
+                v >>= 5
+            out.append(chr(v + 63))
+        prev_lat, prev_lng = ilat, ilng
+    return "".join(out)
+
+
+def decode_polyline(s: str, precision: int = POLYLINE_PRECISION) -> List[List[float]]:
+    factor = 10 ** precision
+    coords: List[List[float]] = []
+    i = lat = lng = 0
+    while i < len(s):
+        vals = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                b = ord(s[i]) - 63
+                i += 1
+                result |= (b & 0x1F) << shift
+                shift += 5
+                if b < 0x20:
+                    break
+            vals.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += vals[0]
+        lng += vals[1]
+        coords.append([lng / factor, lat / factor])
+    return coords
+
+
+def process_sub_polygon(sub: Any, tolerance_m: float) -> Tuple[List[Any], List[str]]:
+    """
+    Accepts a single ring [[lng, lat], ...] (the usual shape) or a list of rings.
+    Returns (cleaned geometry in the same shape, encoded polyline per ring).
+    """
+    if not isinstance(sub, list) or not sub:
+        return [], []
+    if is_point(sub[0]):
+        ring = simplify_ring(clean_ring(sub), tolerance_m)
+        return ring, [encode_polyline(ring)] if ring else []
+
+    rings: List[List[List[float]]] = []
+    seen = set()
+    for r in sub:
+        ring = simplify_ring(clean_ring(r), tolerance_m)
+        key = tuple(map(tuple, ring))
+        if ring and key not in seen:
+            seen.add(key)
+            rings.append(ring)
+    return rings, [encode_polyline(r) for r in rings]
+
+
+def vertex_count(sub: Any) -> int:
+    if not isinstance(sub, list) or not sub:
+        return 0
+    if is_point(sub[0]):
+        return len(sub)
+    return sum(len(r) for r in sub if isinstance(r, list))
+
+
+def apply_geometry(listings: List[ScrapedListing], tolerance_m: float) -> int:
+    """Cleans/simplifies every subPolygon in place. Returns the number of vertices removed."""
+    removed = 0
+    for x in listings:
+        before = vertex_count(x.subPolygon)
+        x.subPolygon, x.subPolygonEncoded = process_sub_polygon(x.subPolygon, tolerance_m)
+        removed += max(0, before - vertex_count(x.subPolygon))
+    return removed
+
+
+# -----------------------------
+# Change-data output (snapshot diffs)
+# -----------------------------
+FIELD_HASH_BYTES = 8
+LISTING_FIELDS = [f.name for f in fields(ScrapedListing)]
+
+
+def field_digest(v: Any) -> bytes:
+    s = json.dumps(v, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(s.encode("utf-8"), digest_size=FIELD_HASH_BYTES).digest()
+
+
+def listing_digest(rec: Dict[str, Any], field_names: List[str]) -> bytes:
+    """
+    Digest of the whole record over `field_names`. Per-field digests are only
+    computed by diff_snapshots, for the records whose digest changed.
+    """
+    return field_digest([rec.get(k) for k in field_names])
+
+
+def build_hash_index(records: Dict[str, Dict[str, Any]], field_names: List[str]) -> Dict[str, bytes]:
+    return {_id: listing_digest(rec, field_names) for _id, rec in records.items()}
+
+
+def hash_index_path(output: str) -> Path:
+    return Path(f"{output}.hashes.json")
+
+
+def save_hash_index(path: Path, field_names: List[str], index: Dict[str, bytes]) -> None:
+    out = {"fields": field_names, "hashes": {k: v.hex() for k, v in index.items()}}
+    path.write_text(json.dumps(out, separators=(",", ":")), encoding="utf-8")
+
+
+def load_hash_index(output: str) -> Optional[Tuple[List[str], Dict[str, bytes]]]:
+    """
+    Returns (field_names, {id: digest}) for the previous snapshot, or None.
+    Prefers the sidecar written by the last --changes run; falls back to
+    hashing the previous snapshot itself.
+    """
+    side = hash_index_path(output)
+    if side.exists():
+        try:
+            raw = json.loads(side.read_text(encoding="utf-8"))
+            return list(raw["fields"]), {k: bytes.fromhex(v) for k, v in raw["hashes"].items()}
+        except Exception:
+            pass
+
+    if not Path(output).exists():
+        return None
+    index: Dict[str, bytes] = {}
+    for rec in load_previous_collection(output):
+        _id = normalize_id(rec)
+        if _id:
+            index[_id] = listing_digest(rec, LISTING_FIELDS)
+    return list(LISTING_FIELDS), index
+
+
+def diff_snapshots(
+    prev: Tuple[List[str], Dict[str, bytes]],
+    cur: Tuple[List[str], Dict[str, bytes]],
+    records: Dict[str, Dict[str, Any]],
+    prev_records: Any,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Yields change records, in current snapshot order then removals:
+      {"op": "insert", "_id": ..., "listing": {...}}
+      {"op": "update", "_id": ..., "fields": {name: new_value}}
+      {"op": "remove", "_id": ...}
+    `prev_records` maps id -> previous listing (a SnapshotReader or a dict); it
+    is only read for listings whose digest changed.
+    """
+    prev_fields, prev_idx = prev
+    cur_fields, cur_idx = cur
+    same_schema = prev_fields == cur_fields
+    added = [k for k in cur_fields if k not in set(prev_fields)]
+
+    for _id, digest in cur_idx.items():
+        old = prev_idx.get(_id)
+        rec = records[_id]
+        if old is None:
+            yield {"op": "insert", "_id": _id, "listing": rec}
+            continue
+
+        # after a schema change, re-hash over the old fields so untouched listings still match
+        if old == (digest if same_schema else listing_digest(rec, prev_fields)):
+            changed = {k: rec.get(k) for k in added if rec.get(k) is not None}
+        else:
+            old_rec = prev_records.get(_id) or {}
+            changed = {k: rec.get(k) for k in cur_fields if field_digest(rec.get(k)) != field_digest(old_rec.get(k))}
+        if changed:
+            yield {"op": "update", "_id": _id, "fields": changed}
+
+    for _id in prev_idx:
+        if _id not in cur_idx:
+            yield {"op": "remove", "_id": _id}
+
+
+def write_changes(path: str, changes: Iterator[Dict[str, Any]]) -> Dict[str, int]:
+    counts = {"insert": 0, "update": 0, "remove": 0}
+    with open(path, "w", encoding="utf-8") as f:
+        for c in changes:
+            counts[c["op"]] += 1
+            f.write(json.dumps(c, ensure_ascii=False, separators=(",", ":")))
+            f.write("\n")
+    return counts
+
+
+# -----------------------------
+# Snapshot files (random access by _id)
+# -----------------------------
+SNAPSHOT_INDEX_MAGIC = b"SLIDX1\0\0"
+SNAPSHOT_INDEX_HEADER = struct.Struct("<8sQIH")  # magic, snapshot size, count, id width
+
+
+def snapshot_index_path(output: str) -> Path:
+    return Path(f"{output}.idx")
+
+
+def write_snapshot(output: str, records: List[Dict[str, Any]]) -> None:
+    """
+    Writes {"collection": [...]} exactly as json.dump(..., indent=2) would, and a
+    sidecar <output>.idx of (id, byte offset, length) sorted by id.
+    Both files are written to temp paths and swapped in atomically.
+    """
+    entries: List[Tuple[bytes, int, int]] = []
+    tmp = Path(f"{output}.tmp")
+    with open(tmp, "wb") as f:
+        pos = f.write(b'{\n  "collection": [')
+        for i, rec in enumerate(records):
+            body = json.dumps(rec, ensure_ascii=False, indent=2).replace("\n", "\n    ").encode("utf-8")
+            pos += f.write(b"\n    " if i == 0 else b",\n    ")
+            _id = normalize_id(rec)
+            if _id:
+                entries.append((_id.encode("utf-8"), pos, len(body)))
+            pos += f.write(body)
+        pos += f.write(b"\n  ]\n}" if records else b"]\n}")
+
+    entries.sort()
+    width = max((len(e[0]) for e in entries), default=0)
+    entry = struct.Struct(f"<{width}sQI")
+    idx_tmp = Path(f"{output}.idx.tmp")
+    with open(idx_tmp, "wb") as f:
+        f.write(SNAPSHOT_INDEX_HEADER.pack(SNAPSHOT_INDEX_MAGIC, pos, len(entries), width))
+        for e in entries:
+            f.write(entry.pack(*e))
+
+    os.replace(tmp, output)
+    os.replace(idx_tmp, snapshot_index_path(output))
+
+
+class SnapshotReader:
+    """
+    Memory-maps a snapshot and its .idx; decodes only the listings asked for.
+    Lookups binary-search the mmapped index, so they don't depend on file size.
+
+        with SnapshotReader("scraped-elminassa-data.json") as snap:
+            snap.get("5bc2...")
+            for listing in snap.range("65a", "65b"): ...
+    """
+
+    def __init__(self, output: str):
+        self._files = [open(output, "rb"), open(snapshot_index_path(output), "rb")]
+        self.data = mmap.mmap(self._files[0].fileno(), 0, access=mmap.ACCESS_READ)
+        self.index = mmap.mmap(self._files[1].fileno(), 0, access=mmap.ACCESS_READ)
+        magic, size, self.count, width = SNAPSHOT_INDEX_HEADER.unpack_from(self.index, 0)
+        if magic != SNAPSHOT_INDEX_MAGIC or size != len(self.data):
+            self.close()
+            raise ValueError(f"{snapshot_index_path(output)} does not match {output}; re-run the scraper")
+        self.entry = struct.Struct(f"<{width}sQI")
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __enter__(self) -> "SnapshotReader":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        for m in ("data", "index"):
+            if hasattr(self, m):
+                getattr(self, m).close()
+        for f in self._files:
+            f.close()
+
+    def _entry(self, i: int) -> Tuple[str, int, int]:
+        raw, off, length = self.entry.unpack_from(self.index, SNAPSHOT_INDEX_HEADER.size + i * self.entry.size)
+        return raw.rstrip(b"\0").decode("utf-8"), off, length
+
+    def _bisect(self, _id: str) -> int:
+        lo, hi = 0, self.count
+        key = _id.encode("utf-8")
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0].encode("utf-8") < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _decode(self, off: int, length: int) -> Dict[str, Any]:
+        return json.loads(self.data[off:off + length].decode("utf-8"))
+
+    def get(self, _id: str) -> Optional[Dict[str, Any]]:
+        i = self._bisect(_id)
+        if i < self.count:
+            found, off, length = self._entry(i)
+            if found == _id:
+                return self._decode(off, length)
+        return None
+
+    def ids(self) -> Iterator[str]:
+        for i in range(self.count):
+            yield self._entry(i)[0]
+
+    def range(self, start: Optional[str] = None, stop: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """Listings with start <= _id < stop, in id order."""
+        i = self._bisect(start) if start else 0
+        while i < self.count:
+            _id, off, length = self._entry(i)
+            if stop is not None and _id >= stop:
+                return
+            yield self._decode(off, length)
+            i += 1
+
+
+def load_previous_collection(output: str) -> List[Dict[str, Any]]:
+    try:
+        with open(output, "r", encoding="utf-8") as f:
+            collection = json.load(f).get("collection") or []
+    except Exception:
+        return []
+    return [x for x in collection if isinstance(x, dict)]
+
+
+def load_previous_ids(output: str) -> set:
+    try:
+        with SnapshotReader(output) as snap:
+            return set(snap.ids())
+    except (OSError, ValueError):
+        return {normalize_id(x) for x in load_previous_collection(output)} - {None}
+
+
+@contextmanager
+def previous_snapshot(output: str) -> Iterator[Any]:
+    """Random access to the previous snapshot by id; parses it whole only when its .idx is missing or stale."""
+    try:
+        snap = SnapshotReader(output)
+    except (OSError, ValueError):
+        yield {normalize_id(x): x for x in load_previous_collection(output)}
+        return
+    with snap:
+        yield snap
+
+
+# -----------------------------
+# Price / visit history (append-only time series)
+# -----------------------------
+HISTORY_ROW = struct.Struct("<IIIqIB")  # epoch, key, prev row, price, visitCount, flags
+HISTORY_NONE = 0xFFFFFFFF
+FLAG_SOLD, FLAG_VISIBLE, FLAG_DELETED, FLAG_GONE = 1, 2, 4, 8
+
+
+class HistoryStore:
+    """
+    Append-only store of price/visitCount/sold/visible per listing across runs.
+
+      ids.txt     listing _id per line (line number = key)
+      epochs.bin  int64 unix time of each run (index = epoch)
+      rows.bin    fixed-width HISTORY_ROW records, appended only when a listing
+                  appears, changes or disappears (FLAG_GONE); each row points to
+                  the previous row of the same listing
+      heads.bin   uint32 last row per key (+ row count header), rewritten per run
+
+    A listing's history is a walk back from its head, so queries touch only
+    that listing's rows.
+    """
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.ids: List[str] = []
+        ids_file = self.root / "ids.txt"
+        if ids_file.exists():
+            self.ids = ids_file.read_text(encoding="utf-8").splitlines()
+        self.keys = {_id: k for k, _id in enumerate(self.ids)}
+
+        self.epochs = array("q")
+        epochs_file = self.root / "epochs.bin"
+        if epochs_file.exists():
+            self.epochs.frombytes(epochs_file.read_bytes())
+
+        rows_file = self.root / "rows.bin"
+        rows_file.touch()
+        self._rows = open(rows_file, "r+b")
+        self._drop_unfinished_run()
+        self.heads = self._load_heads()
+
+    def close(self) -> None:
+        self._rows.close()
+
+    def __enter__(self) -> "HistoryStore":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    @property
+    def row_count(self) -> int:
+        return os.fstat(self._rows.fileno()).st_size // HISTORY_ROW.size
+
+    def _drop_unfinished_run(self) -> None:
+        # rows written by a run that crashed before recording its epoch
+        n = self.row_count
+        while n and self._row(n - 1)[0] >= len(self.epochs):
+            n -= 1
+        self._rows.truncate(n * HISTORY_ROW.size)
+
+    def _row(self, i: int) -> Tuple[int, ...]:
+        self._rows.seek(i * HISTORY_ROW.size)
+        return HISTORY_ROW.unpack(self._rows.read(HISTORY_ROW.size))
+
+    def _load_heads(self) -> array:
+        heads = array("I")
+        f = self.root / "heads.bin"
+        raw = f.read_bytes() if f.exists() else b""
+        if len(raw) >= 4 and struct.unpack_from("<I", raw)[0] == self.row_count:
+            heads.frombytes(raw[4:])
+        else:
+            # missing or stale: rebuild from rows (every recorded id has at least one row)
+            rows = [self._row(i)[1] for i in range(self.row_count)]
+            heads.extend([HISTORY_NONE] * (max(rows) + 1 if rows else 0))
+            for i, key in enumerate(rows):
+                heads[key] = i
+        self._drop_unrecorded_ids(len(heads))
+        return heads
+
+    def _drop_unrecorded_ids(self, n: int) -> None:
+        # ids appended by a run that crashed before its rows/epoch were recorded
+        if len(self.ids) <= n:
+            return
+        for _id in self.ids[n:]:
+            del self.keys[_id]
+        del self.ids[n:]
+        tmp = self.root / "ids.txt.tmp"
+        tmp.write_text("".join(f"{x}\n" for x in self.ids), encoding="utf-8")
+        os.replace(tmp, self.root / "ids.txt")
+
+    def append_run(self, records: List[Dict[str, Any]], ts: Optional[float] = None) -> int:
+        """Records one crawl. Returns the number of rows appended."""
+        epoch = len(self.epochs)
+        new_ids: List[str] = []
+        rows: List[bytes] = []
+        n = self.row_count
+        seen = set()
+
+        for rec in records:
+            _id = normalize_id(rec)
+            if not _id or _id in seen:
+                continue
+            seen.add(_id)
+            key = self.keys.get(_id)
+            if key is None:
+                key = self.keys[_id] = len(self.ids)
+                self.ids.append(_id)
+                self.heads.append(HISTORY_NONE)
+                new_ids.append(_id)
+
+            flags = (
+                (FLAG_SOLD if rec.get("sold") else 0) |
+                (FLAG_VISIBLE if rec.get("visible") else 0) |
+                (FLAG_DELETED if rec.get("deleted") else 0)
+            )
+            price = int(rec.get("price") or 0)
+            visits = max(0, min(int(rec.get("visitCount") or 0), HISTORY_NONE))
+            head = self.heads[key]
+            if head != HISTORY_NONE and self._row(head)[3:] == (price, visits, flags):
+                continue
+            rows.append(HISTORY_ROW.pack(epoch, key, head, price, visits, flags))
+            self.heads[key] = n + len(rows) - 1
+
+        for key, head in enumerate(self.heads):
+            if head == HISTORY_NONE or self.ids[key] in seen:
+                continue
+            _, _, _, price, visits, flags = self._row(head)
+            if not flags & FLAG_GONE:
+                rows.append(HISTORY_ROW.pack(epoch, key, head, price, visits, flags | FLAG_GONE))
+                self.heads[key] = n + len(rows) - 1
+
+        # order matters for crash recovery: ids, rows, epoch, heads
+        if new_ids:
+            with open(self.root / "ids.txt", "a", encoding="utf-8") as f:
+                f.write("".join(f"{x}\n" for x in new_ids))
+        self._rows.seek(0, os.SEEK_END)
+        self._rows.write(b"".join(rows))
+        self._rows.flush()
+        self.epochs.append(int(ts if ts is not None else time.time()))
+        with open(self.root / "epochs.bin", "ab") as f:
+            f.write(self.epochs[-1:].tobytes())
+        tmp = self.root / "heads.bin.tmp"
+        tmp.write_bytes(struct.pack("<I", self.row_count) + self.heads.tobytes())
+        os.replace(tmp, self.root / "heads.bin")
+        return len(rows)
+
+    def history(self, _id: str) -> List[Dict[str, Any]]:
+        """Change points for one listing, oldest first."""
+        key = self.keys.get(_id)
+        out: List[Dict[str, Any]] = []
+        i = self.heads[key] if key is not None else HISTORY_NONE
+        while i != HISTORY_NONE:
+            epoch, _, prev, price, visits, flags = self._row(i)
+            out.append({
+                "ts": self.epochs[epoch],
+                "price": price,
+                "visitCount": visits,
+                "sold": bool(flags & FLAG_SOLD),
+                "visible": bool(flags & FLAG_VISIBLE),
+                "deleted": bool(flags & FLAG_DELETED),
+                "gone": bool(flags & FLAG_GONE),
+            })
+            i = prev
+        out.reverse()
+        return out
+
+    def price_changes(self, _id: str) -> List[Dict[str, Any]]:
+        out: List[Dict[str, Any]] = []
+        last = None
+        for h in self.history(_id):
+            if last is not None and h["price"] != last:
+                out.append({"ts": h["ts"], "from": last, "to": h["price"]})
+            last = h["price"]
+        return out
+
+    def days_on_market(self, _id: str) -> Optional[float]:
+        """From first sighting until it went away / was sold (or the latest run)."""
+        hist = self.history(_id)
+        if not hist:
+            return None
+        end = self.epochs[-1]
+        for h in hist:
+            if h["gone"] or h["sold"]:
+                end = h["ts"]
+                break
+        return (end - hist[0]["ts"]) / 86400
+
+    def view_velocity(self, _id: str, days: float = 7.0) -> Optional[float]:
+        """Visits per day over (roughly) the last `days` days of history."""
+        hist = self.history(_id)
+        if hist and not hist[-1]["gone"]:
+            hist.append({**hist[-1], "ts": self.epochs[-1]})  # unchanged since its last row
+        hist = [h for h in hist if not h["gone"]]
+        if len(hist) < 2:
+            return None
+        last = hist[-1]
+        first = next((h for h in hist if h["ts"] >= last["ts"] - days * 86400), hist[0])
+        if first is last:
+            first = hist[-2]
+        return (last["visitCount"] - first["visitCount"]) / max((last["ts"] - first["ts"]) / 86400, 1e-9)
+
+
+# -----------------------------
+# Full-text index (titles + descriptions)
+# -----------------------------
+ARABIC_CHAR_MAP = str.maketrans({
+    "\u0640": None,      # tatweel
+    "\u0671": "\u0627",  # alef wasla -> alef
+    "\u0649": "\u064a",  # alef maqsura -> yeh
+    "\u0629": "\u0647",  # teh marbuta -> heh
+    **{chr(0x0660 + d): str(d) for d in range(10)},  # Arabic-Indic digits
+    **{chr(0x06F0 + d): str(d) for d in range(10)},  # Eastern Arabic-Indic digits
+})
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+MAX_TERM_CHARS = 40
+
+
+def normalize_text(s: str) -> str:
+    """Lowercase, strip French accents and Arabic diacritics, unify alef/yeh/teh-marbuta forms."""
+    s = unicodedata.normalize("NFKD", s.lower())
+    s = "".join(ch for ch in s if not unicodedata.combining(ch))  # also drops hamza/madda marks
+    return s.translate(ARABIC_CHAR_MAP)
+
+
+STOPWORDS = {normalize_text(w) for w in (
+    "le", "la", "les", "de", "des", "du", "et", "en", "un", "une", "au", "aux", "pour", "avec", "sur", "dans", "par",
+    "est", "ou", "qui", "que", "a",
+    "في", "من", "على", "الى", "إلى", "عن", "مع", "او", "أو", "ثم", "هذا", "هذه", "ذلك", "التي", "الذي",
+)}
+
+
+def tokenize(s: str) -> List[str]:
+    out: List[str] = []
+    for tok in TOKEN_RE.findall(normalize_text(s)):
+        if tok.startswith("ال") and len(tok) > 4:
+            tok = tok[2:]  # Arabic definite article
+        if (len(tok) > 1 or tok.isdigit()) and tok not in STOPWORDS:
+            out.append(tok[:MAX_TERM_CHARS])
+    return out
+
+
+def listing_text(rec: Dict[str, Any]) -> str:
+    return f"{rec.get('title') or ''}\n{rec.get('description') or ''}"
+
+
+TEXT_INDEX_HEADER = struct.Struct("<IH")  # entry count, key width
+TEXT_INDEX_FILES = ("docs.json", "docids.bin", "lexicon.bin", "postings.bin")
+
+
+class TextIndex:
+    """
+    Incrementally maintained inverted index over listing titles/descriptions.
+    <root>/docs.json keeps (digest, terms) per listing so only listings whose
+    text changed are re-tokenized; save() also writes the query-side files
+    read by TextSearcher:
+
+      docids.bin    listing ids sorted, fixed width (position = doc number)
+      lexicon.bin   terms sorted (UTF-8), fixed width, with postings offset/count
+      postings.bin  uint32 doc numbers per term
+    """
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+        self.docs: Dict[str, Tuple[str, List[str]]] = {}  # id -> (digest, terms)
+        docs_file = self.root / "docs.json"
+        if docs_file.exists():
+            raw = json.loads(docs_file.read_text(encoding="utf-8"))
+            self.docs = {_id: (digest, terms) for _id, (digest, terms) in raw.items()}
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def sync(self, records: Iterable[Dict[str, Any]]) -> Dict[str, int]:
+        """Makes the index match `records` (a full snapshot). Returns counts of added/updated/removed/unchanged."""
+        counts = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+        seen = set()
+        for rec in records:
+            _id = normalize_id(rec)
+            if not _id:
+                continue
+            seen.add(_id)
+            text = listing_text(rec)
+            digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+            old = self.docs.get(_id)
+            if old is not None and old[0] == digest:
+                counts["unchanged"] += 1
+                continue
+            self.docs[_id] = (digest, sorted(set(tokenize(text))))
+            counts["updated" if old is not None else "added"] += 1
+
+        for _id in [x for x in self.docs if x not in seen]:
+            del self.docs[_id]
+            counts["removed"] += 1
+        return counts
+
+    def save(self) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        ids = sorted(self.docs)
+        postings: Dict[str, array] = {}
+        for n, _id in enumerate(ids):
+            for t in self.docs[_id][1]:
+                postings.setdefault(t, array("I")).append(n)  # ascending by construction
+
+        out: Dict[str, bytes] = {
+            "docs.json": json.dumps(self.docs, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+        }
+        id_keys = [x.encode("utf-8") for x in ids]
+        width = max(map(len, id_keys), default=0)
+        out["docids.bin"] = TEXT_INDEX_HEADER.pack(len(ids), width) + b"".join(k.ljust(width, b"\0") for k in id_keys)
+
+        terms = sorted((t.encode("utf-8"), t) for t in postings)
+        width = max((len(k) for k, _ in terms), default=0)
+        entry = struct.Struct(f"<{width}sQI")
+        lexicon = [TEXT_INDEX_HEADER.pack(len(terms), width)]
+        blobs: List[bytes] = []
+        offset = 0
+        for key, t in terms:
+            blob = postings[t].tobytes()
+            lexicon.append(entry.pack(key, offset, len(postings[t])))
+            blobs.append(blob)
+            offset += len(blob)
+        out["lexicon.bin"] = b"".join(lexicon)
+        out["postings.bin"] = b"".join(blobs)
+
+        for name in TEXT_INDEX_FILES:
+            tmp = self.root / f"{name}.tmp"
+            tmp.write_bytes(out[name])
+        for name in TEXT_INDEX_FILES:
+            os.replace(self.root / f"{name}.tmp", self.root / name)
+
+
+class TextSearcher:
+    """
+    Queries the files written by TextIndex.save() through mmap: a lookup is a
+    binary search in lexicon.bin plus reading that term's postings, so nothing
+    proportional to the whole index is loaded.
+
+        with TextSearcher("search-index") as idx:
+            idx.search("terrain tevragh")    # AND of terms, "terr*" for prefixes
+    """
+
+    def __init__(self, root: str):
+        root_path = Path(root)
+        self._files = [open(root_path / name, "rb") for name in TEXT_INDEX_FILES[1:]]
+        self._maps = [
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+            for f in self._files
+        ]
+        self.docids, self.lexicon, self.postings = self._maps
+        self.doc_count, id_width = TEXT_INDEX_HEADER.unpack_from(self.docids, 0)
+        self.id_entry = struct.Struct(f"<{id_width}s")
+        self.term_count, term_width = TEXT_INDEX_HEADER.unpack_from(self.lexicon, 0)
+        self.term_entry = struct.Struct(f"<{term_width}sQI")
+
+    def __enter__(self) -> "TextSearcher":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        for m in self._maps:
+            if isinstance(m, mmap.mmap):
+                m.close()
+        for f in self._files:
+            f.close()
+
+    def _term(self, i: int) -> Tuple[bytes, int, int]:
+        key, off, n = self.term_entry.unpack_from(self.lexicon, TEXT_INDEX_HEADER.size + i * self.term_entry.size)
+        return key.rstrip(b"\0"), off, n
+
+    def _bisect(self, key: bytes) -> int:
+        lo, hi = 0, self.term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _postings(self, off: int, n: int) -> array:
+        docs = array("I")
+        docs.frombytes(self.postings[off:off + 4 * n])
+        return docs
+
+    def _match(self, term: str) -> set:
+        prefix = term.endswith("*")
+        key = (term[:-1] if prefix else term).encode("utf-8")
+        out: set = set()
+        i = self._bisect(key)
+        while i < self.term_count:
+            found, off, n = self._term(i)
+            if found != key and not (prefix and found.startswith(key)):
+                break
+            out.update(self._postings(off, n))
+            if not prefix:
+                break
+            i += 1
+        return out
+
+    def doc_id(self, n: int) -> str:
+        raw = self.id_entry.unpack_from(self.docids, TEXT_INDEX_HEADER.size + n * self.id_entry.size)[0]
+        return raw.rstrip(b"\0").decode("utf-8")
+
+    def search(self, query: str, limit: int = 50) -> List[str]:
+        terms: List[str] = []
+        for raw in query.split():
+            toks = tokenize(raw)
+            if toks and raw.endswith("*"):
+                toks[-1] += "*"
+            terms += toks
+        if not terms:
+            return []
+        sets = sorted((self._match(t) for t in terms), key=len)
+        hits = set(sets[0])
+        for s in sets[1:]:
+            hits &= s
+            if not hits:
+                break
+        # doc numbers follow id order
+        return [self.doc_id(n) for n in heapq.nsmallest(limit, hits)]
+
+
+# -----------------------------
+# Columnar export (Arrow / Parquet)
+# -----------------------------
+PARQUET_BATCH_ROWS = 5000
+PARQUET_STR_FIELDS = [
+    "_id", "title", "description", "category", "subCategory", "region", "contractType",
+    "publicationDate", "subPolygonColor", "clientName", "clientPhoneNumber",
+    "lotissement", "index", "ilotSize", "polygoneArea", "elevation", "sidesLength", "matterportLink",
+]
+PARQUET_BOOL_FIELDS = ["sold", "deleted", "tobedeleted", "visible", "professional", "isRealLocation"]
+PARQUET_PUBLISHER_FIELDS = ["userId", "name", "phoneNumber", "email"]
+
+
+def opt_str(v: Any) -> Optional[str]:
+    if v is None:
+        return None
+    return v if isinstance(v, str) else json.dumps(v, ensure_ascii=False)
+
+
+def parquet_schema():
+    import pyarrow as pa
+
+    cols = [pa.field(k, pa.string()) for k in PARQUET_STR_FIELDS]
+    cols += [pa.field(k, pa.bool_()) for k in PARQUET_BOOL_FIELDS]
+    cols += [pa.field(f"publisher_{k}", pa.string()) for k in PARQUET_PUBLISHER_FIELDS]
+    cols += [
+        pa.field("price", pa.int64()),
+        pa.field("visitCount", pa.int64()),
+        pa.field("lng", pa.float64()),
+        pa.field("lat", pa.float64()),
+        pa.field("photos", pa.list_(pa.string())),
+        pa.field("videos", pa.list_(pa.string())),
+        pa.field("lot", pa.list_(pa.string())),
+        pa.field("thumbnails", pa.list_(pa.string())),
+        pa.field("subPolygonEncoded", pa.list_(pa.string())),
+        pa.field("subPolygon", pa.string()),  # raw rings as compact JSON
+        pa.field("scraped_at", pa.timestamp("s", tz="UTC")),
+        pa.field("scrape_date", pa.string()),
+    ]
+    return pa.schema(cols)
+
+
+def listing_to_row(rec: Dict[str, Any], scraped_at: datetime) -> Dict[str, Any]:
+    """Flattens one ScrapedListing dict (geometry -> lng/lat, publisher -> publisher_*)."""
+    row: Dict[str, Any] = {k: opt_str(rec.get(k)) for k in PARQUET_STR_FIELDS}
+    row.update({k: bool(rec.get(k)) for k in PARQUET_BOOL_FIELDS})
+
+    pub = rec.get("publisher") if isinstance(rec.get("publisher"), dict) else {}
+    row.update({f"publisher_{k}": opt_str(pub.get(k)) for k in PARQUET_PUBLISHER_FIELDS})
+
+    coords = (rec.get("geometry") or {}).get("coordinates") or [None, None]
+    row["lng"], row["lat"] = coords[0], coords[1]
+    row["price"] = rec.get("price")
+    row["visitCount"] = rec.get("visitCount")
+    row["photos"] = rec.get("photos") or []
+    row["videos"] = rec.get("videos") or []
+    row["lot"] = rec.get("lot") or []
+    row["thumbnails"] = rec.get("thumbnails") or []
+    row["subPolygonEncoded"] = rec.get("subPolygonEncoded") or []
+    sub = rec.get("subPolygon")
+    row["subPolygon"] = json.dumps(sub, separators=(",", ":")) if sub else None
+    row["scraped_at"] = scraped_at
+    row["scrape_date"] = scraped_at.strftime("%Y-%m-%d")
+    return row
+
+
+def iter_record_batches(records: List[Dict[str, Any]], scraped_at: datetime, batch_rows: int = PARQUET_BATCH_ROWS):
+    import pyarrow as pa
+
+    schema = parquet_schema()
+    for i in range(0, len(records), batch_rows):
+        rows = [listing_to_row(r, scraped_at) for r in records[i:i + batch_rows]]
+        yield pa.RecordBatch.from_pylist(rows, schema=schema)
+
+
+def write_parquet(records: List[Dict[str, Any]], root: str, scraped_at: Optional[datetime] = None) -> int:
+    """
+    Appends one run to a Hive-partitioned dataset: <root>/scrape_date=YYYY-MM-DD/region=<region>/.
+    Returns the number of rows written.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        # parse_args checks this up front; a plain error here keeps a daemon alive
+        raise RuntimeError("--parquet requires pyarrow (pip install pyarrow)") from e
+
+    scraped_at = scraped_at or datetime.now(timezone.utc).replace(microsecond=0)
+    batches = list(iter_record_batches(records, scraped_at))
+    if not batches:
+        return 0
+
+    table = pa.Table.from_batches(batches, schema=parquet_schema())
+    pq.write_to_dataset(
+        table,
+        root_path=root,
+        partition_cols=["scrape_date", "region"],
+        basename_template=f"part-{scraped_at.strftime('%H%M%S')}-{{i}}.parquet",
+        compression="zstd",
+    )
+    return table.num_rows
+
+
+# -----------------------------
+# Media verification + thumbnails
+# -----------------------------
+THUMB_SIZE = (480, 480)
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp")
+
+
+def is_image_url(url: str) -> bool:
+    return url.split("?", 1)[0].lower().endswith(IMAGE_EXTS)
+
+
+def thumb_name(url: str) -> str:
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()[:20] + ".jpg"
+
+
+def make_thumbnail(data: bytes, dest: str, size: Tuple[int, int] = THUMB_SIZE) -> bool:
+    # Runs in a worker process (CPU bound). Written via a temp file: an existing
+    # dest is treated as a cached thumbnail, so it must never be partial.
+    import io
+
+    tmp = f"{dest}.{os.getpid()}.tmp"
+    try:
+        from PIL import Image
+
+        with Image.open(io.BytesIO(data)) as im:
+            im.thumbnail(size)
+            im.convert("RGB").save(tmp, "JPEG", quality=80, optimize=True)
+        os.replace(tmp, dest)
+        return True
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return False
+
+
+MEDIA_DEAD_STATUSES = (403, 404, 410)  # 403 only counts once a GET was refused too
+
+
+def media_status(status: int) -> Optional[bool]:
+    """Maps a GET status to alive (True), dead (False) or unknown (None: 429, 5xx, ...)."""
+    if 200 <= status < 300:
+        return True
+    if status in MEDIA_DEAD_STATUSES:
+        return False
+    return None
+
+
+async def check_media_url(request, url: str, timeout_ms: int = 15000) -> Optional[bool]:
+    """
+    True = alive, False = dead (404/410, or 403 to GET), None = unknown
+    (rate limited, server error, network error/timeout).
+    Falls back to a 1-byte ranged GET when the server refuses HEAD.
+    """
+    try:
+        r = await request.head(url, timeout=timeout_ms)
+        if r.status in (403, 405, 501):
+            r = await request.get(url, headers={"Range": "bytes=0-0"}, timeout=timeout_ms)
+        return media_status(r.status)
+    except Exception:
+        return None
+
+
+async def process_media(
+    request,
+    urls: List[str],
+    concurrency: int = 32,
+    thumbs_dir: Optional[str] = None,
+    timeout_ms: int = 15000,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Checks each unique URL once and optionally thumbnails images.
+    Network work is bounded by `concurrency`; resizing runs in a process pool.
+    Returns {url: {"ok": True|False|None, "thumb": path|None}}.
+    """
+    results: Dict[str, Dict[str, Any]] = {}
+    sem = asyncio.Semaphore(concurrency)
+    out_dir = Path(thumbs_dir) if thumbs_dir else None
+    if out_dir:
+        out_dir.mkdir(parents=True, exist_ok=True)
+    loop = asyncio.get_running_loop()
+    workers = os.cpu_count() or 1
+    pool = ProcessPoolExecutor(max_workers=workers) if out_dir else None
+    # bounds the number of downloaded bodies waiting on the pool
+    cpu_sem = asyncio.Semaphore(2 * workers)
+
+    async def one(url: str):
+        info: Dict[str, Any] = {"ok": None, "thumb": None}
+        results[url] = info
+        dest = out_dir / thumb_name(url) if out_dir and is_image_url(url) else None
+
+        if dest is None or dest.exists():
+            async with sem:
+                info["ok"] = await check_media_url(request, url, timeout_ms)
+            if dest is not None and info["ok"] is not False:
+                info["thumb"] = str(dest)
+            return
+
+        async with cpu_sem:
+            async with sem:
+                try:
+                    r = await request.get(url, timeout=timeout_ms)
+                    info["ok"] = media_status(r.status)
+                    data = await r.body() if r.ok else None
+                except Exception:
+                    data = None
+            if not data:
+                return
+            try:
+                made = await loop.run_in_executor(pool, make_thumbnail, data, str(dest))
+            except Exception:
+                made = False  # e.g. a broken process pool: no thumbnail, the crawl goes on
+            if made:
+                info["thumb"] = str(dest)
+
+    try:
+        await asyncio.gather(*[one(u) for u in dict.fromkeys(urls)])
+    finally:
+        if pool:
+            pool.shutdown()
+    return results
+
+
+def thumb_ref(path: str, base_url: Optional[str]) -> str:
+    # local cache paths are only meaningful on the scraping host
+    return f"{base_url.rstrip('/')}/{Path(path).name}" if base_url else path
+
+
+def apply_media_results(
+    listings: List[ScrapedListing],
+    results: Dict[str, Dict[str, Any]],
+    thumbs_base_url: Optional[str] = None,
+) -> int:
+    """
+    Drops dead photos/videos and attaches thumbnails. Thumbnails are URLs under
+    `thumbs_base_url` when given, otherwise local cache paths (not servable by
+    the web app). Returns the number of URLs dropped.
+    """
+    dropped = 0
+    for x in listings:
+        photos = [u for u in x.photos if results.get(u, {}).get("ok") is not False]
+        videos = [u for u in x.videos if results.get(u, {}).get("ok") is not False]
+        dropped += len(x.photos) - len(photos) + len(x.videos) - len(videos)
+        x.photos, x.videos = photos, videos
+        x.thumbnails = [thumb_ref(results[u]["thumb"], thumbs_base_url) for u in photos if results.get(u, {}).get("thumb")]
+    return dropped
+
+
 async def click_load_more(page: Page) -> bool:
     return await page.evaluate(
         """
@@ -320,20 +1471,244 @@ async def click_load_more(page: Page) -> bool:
     )
 
 
-async def hydrate_from_details(browser: Browser, ad_id: str, user_agent: str) -> Optional[Dict[str, Any]]:
+# -----------------------------
+# Request routing (network filtering)
+# -----------------------------
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media"}
+JSON_RESOURCE_TYPES = {"xhr", "fetch"}
+TILE_URL_RE = re.compile(
+    r"/tiles?/|/\d+/\d+/\d+(@2x)?\.(png|jpe?g|webp|pbf|mvt)\b|\.(pbf|mvt)(\?|$)|"
+    r"tile\.openstreetmap\.org|basemaps\.cartocdn\.com|api\.mapbox\.com/(styles|v4)/|"
+    r"maps\.googleapis\.com/maps/vt|mt\d\.google\.com",
+    re.I,
+)
+ID_SEGMENT_RE = re.compile(r"^([0-9a-f]{24}|[0-9a-f-]{32,36}|\d+)$", re.I)
+
+
+def should_block(resource_type: str, url: str) -> bool:
+    return resource_type in BLOCKED_RESOURCE_TYPES or bool(TILE_URL_RE.search(url))
+
+
+def endpoint_key(url: str) -> str:
+    # host + path, with id-like segments collapsed: api.x.com/adDetails/65ab.. -> api.x.com/adDetails/*
+    u = urlsplit(url)
+    segs = ["*" if ID_SEGMENT_RE.match(seg) else seg for seg in u.path.split("/")]
+    return u.netloc + "/".join(segs)
+
+
+class EndpointFilter:
+    """
+    Decides which XHR/fetch bodies are worth buffering.
+    Endpoints are tracked per scope ("discovery", "details"); a scope with no
+    known endpoints buffers everything, as does learning mode. So does a scope
+    whose known endpoints yielded nothing on a settled page (see missed()).
+    """
+
+    def __init__(self, path: str, learn: bool = False):
+        self.path = Path(path)
+        self.learn = learn
+        self.known: Dict[str, Dict[str, int]] = {}
+        if self.path.exists():
+            try:
+                self.known = json.loads(self.path.read_text(encoding="utf-8"))
+            except Exception:
+                self.known = {}
+        self.hits: Dict[str, Dict[str, int]] = {}
+        self.fallback: set = set()
+
+    def wants_body(self, scope: str, resource_type: str, url: str) -> bool:
+        if resource_type not in JSON_RESOURCE_TYPES:
+            return False
+        known = self.known.get(scope)
+        return self.learn or not known or scope in self.fallback or endpoint_key(url) in known
+
+    def missed(self, scope: str, captured: int) -> bool:
+        """
+        Call once a page has settled. If the known endpoints of `scope` gave no
+        listings (API moved, or the file was learned by another scraper), buffer
+        every XHR/fetch for that scope from now on. Returns True when the
+        fallback was just switched on, i.e. the page is worth reloading.
+        """
+        if captured or self.learn or not self.known.get(scope) or scope in self.fallback:
+            return False
+        self.fallback.add(scope)
+        log(f"⚠️  No listings from known {scope} endpoints in {self.path}; buffering all XHR/fetch (re-learn with --learn-endpoints)")
+        return True
+
+    def record(self, scope: str, url: str, n_hits: int) -> None:
+        if n_hits:
+            seen = self.hits.setdefault(scope, {})
+            key = endpoint_key(url)
+            seen[key] = seen.get(key, 0) + n_hits
+
+    def save(self) -> None:
+        if not self.learn:
+            return
+        merged = {k: dict(v) for k, v in self.known.items()}
+        for scope, seen in self.hits.items():
+            dst = merged.setdefault(scope, {})
+            for k, n in seen.items():
+                dst[k] = dst.get(k, 0) + n
+        self.path.write_text(json.dumps(merged, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+async def install_routing(page: Page, stats: Dict[str, int]) -> None:
+    async def handle(route):
+        req = route.request
+        if should_block(req.resource_type, req.url):
+            stats["aborted"] = stats.get("aborted", 0) + 1
+            await route.abort()
+        else:
+            await route.continue_()
+
+    await page.route("**/*", handle)
+
+
+# -----------------------------
+# Pagination termination
+# -----------------------------
+TOTAL_KEYS = ("total", "totalCount", "total_count", "totalDocs", "totalResults", "totalItems", "totalElements")
+MORE_KEYS = ("hasMore", "has_more", "hasNextPage", "has_next_page", "hasNext")
+CURSOR_KEYS = ("nextCursor", "next_cursor", "nextPage", "next_page")
+HINT_CONTAINERS = ("meta", "pagination", "pageInfo", "paging", "data")
+
+
+def extract_feed_hints(payload: Any, n_hits: int) -> Dict[str, Any]:
+    """
+    Reads server-side pagination fields from a listing payload (top level or one
+    container deep). Returns {"total": int} and/or {"has_more": bool}.
+    A total is only trusted when it exceeds the payload's own `n_hits`; a
+    per-page count looks the same as a feed total otherwise.
+    """
+    hints: Dict[str, Any] = {}
+    if not isinstance(payload, dict):
+        return hints
+    nodes = [payload] + [payload[k] for k in HINT_CONTAINERS if isinstance(payload.get(k), dict)]
+
+    for node in nodes:
+        for k in TOTAL_KEYS:
+            v = node.get(k)
+            if isinstance(v, int) and not isinstance(v, bool) and v > n_hits:
+                hints.setdefault("total", v)
+        for k in MORE_KEYS:
+            if isinstance(node.get(k), bool):
+                hints.setdefault("has_more", node[k])
+        for k in CURSOR_KEYS:
+            if k in node and not isinstance(node[k], (dict, list)):
+                v = node[k]  # a cursor of 0 is still a cursor
+                hints.setdefault("has_more", not (v is None or v is False or v == ""))
+        page, pages = node.get("page"), node.get("totalPages") or node.get("pages")
+        if isinstance(page, int) and isinstance(pages, int) and pages > 0:
+            hints.setdefault("has_more", page < pages)
+    return hints
+
+
+class FeedTracker:
+    """
+    Decides when the scroll feed is exhausted.
+    1) server hints: total reached, or hasMore/cursor says no more pages
+    2) otherwise a growth model: once a step yields a partial page (fewer new IDs
+       than the usual page size) and we have stalled longer than any gap the feed
+       recovered from before, stop
+    Steps with listing requests still in flight don't count as stalls (slow feed).
+    `max_stall` stays the hard upper bound.
+    """
+
+    def __init__(self, max_stall: int):
+        self.max_stall = max_stall
+        self.total: Optional[int] = None
+        self.has_more: Optional[bool] = None
+        self.deltas: List[int] = []
+        self.max_gap = 0
+        self.stalls = 0
+        self.slow_waits = 0
+        self.pending = 0
+
+    def watch(self, page: Page) -> None:
+        def started(req):
+            if req.resource_type in JSON_RESOURCE_TYPES:
+                self.pending += 1
+
+        def done(req):
+            if req.resource_type in JSON_RESOURCE_TYPES:
+                self.pending = max(0, self.pending - 1)
+
+        page.on("request", started)
+        page.on("requestfinished", done)
+        page.on("requestfailed", done)
+
+    def observe(self, payload: Any, n_hits: int) -> None:
+        hints = extract_feed_hints(payload, n_hits)
+        if "total" in hints:
+            self.total = max(self.total or 0, hints["total"])
+        if "has_more" in hints:
+            self.has_more = hints["has_more"]
+
+    @property
+    def idle(self) -> int:
+        """No-growth steps since the last growth, slow waits included."""
+        return self.stalls + self.slow_waits
+
+    def last_page_partial(self) -> bool:
+        if len(self.deltas) < 2:
+            return False
+        page_size = Counter(self.deltas[:-1]).most_common(1)[0][0]
+        return self.deltas[-1] < page_size
+
+    def step(self, delta: int, count: int) -> Optional[str]:
+        """Returns a stop reason, or None to keep scrolling."""
+        if self.total and count >= self.total:
+            return f"server total reached ({count}/{self.total})"
+
+        if delta > 0:
+            self.max_gap = max(self.max_gap, self.stalls)
+            self.stalls = self.slow_waits = 0
+            self.deltas.append(delta)
+            return None
+
+        # slow waits and stalls share the max_stall budget
+        if self.pending > 0 and self.idle + 1 < self.max_stall:
+            self.slow_waits += 1
+            return None
+
+        self.stalls += 1
+        if self.has_more is False:
+            return "server reports no more pages"
+        if self.idle >= self.max_stall:
+            return f"no growth for {self.idle} steps"
+        server_says_more = self.has_more is True or (self.total is not None and count < self.total)
+        if not server_says_more and self.stalls > self.max_gap and self.last_page_partial():
+            return "last page was partial"
+        return None
+
+
+async def hydrate_from_details(
+    browser: Browser,
+    ad_id: str,
+    user_agent: str,
+    endpoints: Optional[EndpointFilter] = None,
+    route_stats: Optional[Dict[str, int]] = None,
+) -> Optional[Dict[str, Any]]:
     url = f"https://www.elminassa.com/adDetails/{ad_id}"
     page = await browser.new_page(viewport={"width": 1400, "height": 900}, user_agent=user_agent)
+    if route_stats is not None:
+        await install_routing(page, route_stats)
 
     found: List[Dict[str, Any]] = []
 
     async def on_resp(resp):
         try:
-            if resp.request.resource_type not in ("xhr", "fetch"):
+            if endpoints is not None:
+                if not endpoints.wants_body("details", resp.request.resource_type, resp.url):
+                    return
+            elif resp.request.resource_type not in JSON_RESOURCE_TYPES:
                 return
             j = await try_read_json(resp)
             if not j:
                 return
             hits = collect_listings_deep(j)
+            if endpoints is not None:
+                endpoints.record("details", resp.url, len(hits))
             for h in hits:
                 hid = normalize_id(h)
                 if hid == ad_id:
@@ -346,6 +1721,9 @@ async def hydrate_from_details(browser: Browser, ad_id: str, user_agent: str) ->
     try:
         await page.goto(url, wait_until="domcontentloaded", timeout=60000)
         await page.wait_for_timeout(3500)
+        if endpoints is not None and endpoints.missed("details", len(found)):
+            await page.reload(wait_until="domcontentloaded", timeout=60000)
+            await page.wait_for_timeout(3500)
 
         # Also check window globals (sometimes data injected)
         window_candidates = await page.evaluate(
@@ -378,137 +1756,602 @@ async def hydrate_from_details(browser: Browser, ad_id: str, user_agent: str) ->
         await page.close()
 
 
-async def main():
-    args = parse_args()
+# -----------------------------
+# Pipelined hydration
+# -----------------------------
+def hydration_priority(raw: Dict[str, Any], is_new: bool, was_deferred: bool) -> Tuple[int, int, int]:
+    """Lower sorts first: new ads, then ads deferred by the last run, then by visitCount, missing coords first."""
+    tier = 0 if is_new else 1 if was_deferred else 2
+    missing = extract_coordinates(raw)[0] is None
+    return (tier, -raw_visit_count(raw), 0 if missing else 1)
 
-    user_agent = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-    hydrate_details = not args.no_details
 
-    log("\n🕷️  elminassa scraper (Python v2)")
-    log(f"URL: {args.url}")
-    log(f"Output: {args.output}")
-    log(f"max={args.max} scroll={args.scroll} details={'ON' if hydrate_details else 'OFF'} concurrency={args.concurrency}\n")
+def deferred_path(output: str) -> Path:
+    return Path(f"{output}.deferred.json")
 
-    by_id: Dict[str, Dict[str, Any]] = {}
-    debug_samples: List[Dict[str, Any]] = []
 
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(headless=not args.headful)
-        page = await browser.new_page(viewport={"width": 1920, "height": 1080}, user_agent=user_agent)
+def load_deferred(output: str) -> set:
+    try:
+        return set(json.loads(deferred_path(output).read_text(encoding="utf-8")))
+    except Exception:
+        return set()
 
-        async def on_response(resp):
+
+def save_deferred(output: str, ids: List[str]) -> None:
+    deferred_path(output).write_text(json.dumps(ids), encoding="utf-8")
+
+
+class HydrationPipeline:
+    """
+    Priority queue between discovery and detail hydration.
+    Discovery pushes IDs as soon as they are seen; `workers` tasks drain the
+    best-priority ID first while scrolling continues. The scroll loop waits
+    while the backlog exceeds `maxsize`. Once `deadline` (time.monotonic())
+    passes, unfinished IDs are collected in `deferred` instead of hydrated.
+    """
+
+    def __init__(self, fn, workers: int, maxsize: int, deadline: Optional[float] = None):
+        self.fn = fn
+        self.queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self.maxsize = maxsize
+        self.workers = workers
+        self.deadline = deadline
+        self.tasks: List[asyncio.Task] = []
+        self.seen: set = set()
+        self.seq = itertools.count()
+        self.deferred: List[str] = []
+        self.done = 0
+
+    def start(self) -> None:
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def remaining(self) -> Optional[float]:
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def expired(self) -> bool:
+        left = self.remaining()
+        return left is not None and left <= 0
+
+    async def put(self, _id: str, priority: Tuple = ()) -> None:
+        if _id in self.seen:
+            return
+        self.seen.add(_id)
+        self.queue.put_nowait((priority, next(self.seq), _id))
+
+    async def wait_for_room(self) -> None:
+        # backpressure for the scroll loop
+        while self.queue.qsize() >= self.maxsize and not self.expired():
+            await asyncio.sleep(0.25)
+
+    async def _worker(self) -> None:
+        while True:
+            _, _, _id = await self.queue.get()
             try:
-                if resp.request.resource_type not in ("xhr", "fetch"):
-                    return
-                j = await try_read_json(resp)
-                if not j:
-                    return
-                hits = collect_listings_deep(j)
-                if not hits:
+                if _id is None:
                     return
+                if self.expired():
+                    self.deferred.append(_id)
+                    continue
+                await asyncio.wait_for(self.fn(_id), self.remaining())
+                self.done += 1
+            except asyncio.TimeoutError:
+                self.deferred.append(_id)
+            except Exception:
+                pass
+            finally:
+                self.queue.task_done()
 
-                if args.debug and len(debug_samples) < 200:
-                    debug_samples.append({"url": resp.url, "sampleKeys": list(hits[0].keys()) if isinstance(hits[0], dict) else []})
+    async def close(self) -> None:
+        for _ in self.tasks:
+            self.queue.put_nowait(((math.inf,), next(self.seq), None))
+        await asyncio.gather(*self.tasks)
 
-                for h in hits:
-                    _id = normalize_id(h)
-                    if not _id:
-                        continue
 
-                    if _id not in by_id:
-                        by_id[_id] = h
-                    else:
-                        prev = by_id[_id]
-                        prev_has_geo = isinstance(prev.get("geometry"), dict) and isinstance(prev["geometry"].get("coordinates"), list)
-                        new_has_geo = isinstance(h.get("geometry"), dict) and isinstance(h["geometry"].get("coordinates"), list)
-                        if (not prev_has_geo) and new_has_geo:
-                            by_id[_id] = h
-            except Exception:
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+
+class WarmPage:
+    """
+    A discovery page that has already loaded args.url. Listing payloads that
+    arrive before a crawl attaches (the initial feed) are buffered and replayed.
+    """
+
+    def __init__(self, page: Page):
+        self.page = page
+        self.buffer: List[Tuple[str, Any, List[Dict[str, Any]]]] = []
+        self.handler = None
+
+    async def deliver(self, url: str, j: Any, hits: List[Dict[str, Any]]) -> None:
+        if self.handler is None:
+            self.buffer.append((url, j, hits))
+        else:
+            await self.handler(url, j, hits)
+
+    async def attach(self, handler) -> None:
+        self.handler = handler
+        buffered, self.buffer = self.buffer, []
+        for item in buffered:
+            await handler(*item)
+
+
+async def open_discovery_page(
+    browser: Browser,
+    url: str,
+    endpoints: EndpointFilter,
+    route_stats: Optional[Dict[str, int]],
+    user_agent: str = USER_AGENT,
+) -> WarmPage:
+    page = await browser.new_page(viewport={"width": 1920, "height": 1080}, user_agent=user_agent)
+    if route_stats is not None:
+        await install_routing(page, route_stats)
+    warm = WarmPage(page)
+
+    async def on_response(resp):
+        try:
+            if not endpoints.wants_body("discovery", resp.request.resource_type, resp.url):
                 return
+            j = await try_read_json(resp)
+            if not j:
+                return
+            hits = collect_listings_deep(j)
+            endpoints.record("discovery", resp.url, len(hits))
+            if hits:
+                await warm.deliver(resp.url, j, hits)
+        except Exception:
+            return
 
-        page.on("response", on_response)
+    page.on("response", on_response)
 
-        await page.goto(args.url, wait_until="networkidle", timeout=60000)
+    await page.goto(url, wait_until="networkidle", timeout=60000)
+    await page.wait_for_timeout(4000)
+    if endpoints.missed("discovery", len(warm.buffer)):
+        await page.reload(wait_until="networkidle", timeout=60000)
         await page.wait_for_timeout(4000)
+    return warm
+
+
+async def crawl(
+    args: argparse.Namespace,
+    p,
+    browser: Browser,
+    warm: WarmPage,
+    endpoints: EndpointFilter,
+    route_stats: Optional[Dict[str, int]],
+    user_agent: str = USER_AGENT,
+) -> int:
+    """One discovery + hydration + export pass on an already-loaded page. Returns the number of ads saved."""
+    hydrate_details = not args.no_details
+    deadline = time.monotonic() + args.deadline if args.deadline > 0 else None
+    prev_ids = load_previous_ids(args.output)
+    was_deferred = load_deferred(args.output)
+    by_id: Dict[str, Dict[str, Any]] = {}
+    debug_samples: List[Dict[str, Any]] = []
+    feed = FeedTracker(args.stall)
+    page = warm.page
 
-        stalls = 0
-        prev_count = 0
+    def has_geo(o: Dict[str, Any]) -> bool:
+        return isinstance(o.get("geometry"), dict) and isinstance(o["geometry"].get("coordinates"), list)
 
-        for step in range(1, args.scroll + 1):
-            await page.evaluate("() => window.scrollTo({ top: document.body.scrollHeight, behavior: 'smooth' })")
-            await page.wait_for_timeout(1800)
+    async def hydrate_one(_id: str):
+        # may have gained coords from a later discovery payload while queued
+        if extract_coordinates(by_id.get(_id) or {})[0] is not None:
+            return
+        full = await hydrate_from_details(browser, _id, user_agent, endpoints, route_stats)
+        if full:
+            prev = by_id.get(_id) or {}
+            if has_geo(full) or not has_geo(prev):
+                by_id[_id] = full
+
+    def priority(_id: str) -> Tuple[int, int, int]:
+        return hydration_priority(by_id[_id], _id not in prev_ids, _id in was_deferred)
+
+    pipeline = HydrationPipeline(hydrate_one, args.concurrency, maxsize=4 * args.concurrency, deadline=deadline)
+    if hydrate_details:
+        pipeline.start()
+
+    async def on_payload(url: str, j: Any, hits: List[Dict[str, Any]]):
+        feed.observe(j, len(hits))
+
+        if args.debug and len(debug_samples) < 200:
+            debug_samples.append({"url": url, "sampleKeys": list(hits[0].keys()) if isinstance(hits[0], dict) else []})
+
+        fresh: List[str] = []
+        for h in hits:
+            _id = normalize_id(h)
+            if not _id:
+                continue
+
+            if _id not in by_id:
+                by_id[_id] = h
+                fresh.append(_id)
+            elif not has_geo(by_id[_id]) and has_geo(h):
+                by_id[_id] = h
+
+        if hydrate_details:
+            for _id in fresh:
+                if extract_coordinates(by_id[_id])[0] is None:
+                    await pipeline.put(_id, priority(_id))
+
+    await warm.attach(on_payload)
+    feed.watch(page)
+
+    prev_count = 0
+
+    for step in range(1, args.scroll + 1):
+        await pipeline.wait_for_room()
+        await page.evaluate("() => window.scrollTo({ top: document.body.scrollHeight, behavior: 'smooth' })")
+        await page.wait_for_timeout(1800)
+
+        clicked = await click_load_more(page)
+        if clicked:
+            await page.wait_for_timeout(2200)
+
+        now = len(by_id)
+        if now >= args.max:
+            log(f"✅ Reached max={args.max}")
+            break
+
+        delta = now - prev_count
+        stop = feed.step(delta, now)
+        if delta > 0:
+            log(f"📈 Step {step}/{args.scroll}: +{delta} ads (total: {now})")
+            prev_count = now
+        else:
+            log(f"⏳ Step {step}/{args.scroll}: no new ads (stall {feed.idle}/{args.stall}, pending={feed.pending})")
+        if stop:
+            log(f"🏁 Feed exhausted: {stop}")
+            break
+
+    if args.debug:
+        with open("debug-api-samples.json", "w", encoding="utf-8") as f:
+            json.dump(debug_samples, f, ensure_ascii=False, indent=2)
+        log("🧪 Saved debug-api-samples.json")
+
+    log(f"\n📦 Captured unique ads from XHR: {len(by_id)}")
+
+    # Finish hydrating missing coords (most of it already ran during scrolling)
+    if hydrate_details:
+        for _id, raw in list(by_id.items()):
+            if extract_coordinates(raw)[0] is None:
+                await pipeline.put(_id, priority(_id))
+
+        if pipeline.seen:
+            log(f"🧭 Hydrating missing coords via details: {pipeline.done}/{len(pipeline.seen)} done during discovery, finishing...")
+            await pipeline.close()
+            log("✅ Details hydration done.")
+        else:
+            await pipeline.close()
+            log("✅ All captured ads already have coords.")
+        if pipeline.deferred:
+            log(f"⏰ Deferred {len(pipeline.deferred)} ads to the next run")
+        save_deferred(args.output, pipeline.deferred)
+
+    # Transform
+    final_listings = []
+    for _id, raw in by_id.items():
+        if normalize_id(raw) is None:
+            raw = {**raw, "_id": _id}
+        final_listings.append(to_scraped_listing(raw))
+
+    final_listings = final_listings[: args.max]
+    if not final_listings and prev_ids:
+        # downstream, an empty snapshot reads as every ad removed (--changes), gone (--history), deleted (--search-index)
+        log(f"⚠️  Captured no ads; keeping the previous snapshot of {len(prev_ids)} ads in {args.output}")
+        return 0
+
+    removed = apply_geometry(final_listings, args.geom_tolerance)
+    if removed:
+        log(f"📐 Geometry: removed {removed} duplicate/redundant subPolygon vertices")
+
+    if (args.verify_media or args.thumbs) and final_listings:
+        urls = [u for x in final_listings for u in x.photos + x.videos]
+        log(f"🖼️  Checking {len(set(urls))} unique media URLs (concurrency={args.media_concurrency})...")
+        request = await p.request.new_context(user_agent=user_agent)
+        try:
+            media = await process_media(request, urls, args.media_concurrency, args.thumbs)
+        finally:
+            await request.dispose()
+        dropped = apply_media_results(final_listings, media, args.thumbs_base_url)
+        thumbs = sum(1 for v in media.values() if v["thumb"])
+        log(f"✅ Media: dropped {dropped} dead URLs, {thumbs} thumbnails")
+
+    uniq_coords = len({",".join(map(str, x.geometry["coordinates"])) for x in final_listings})
+    log(f"📍 Unique coordinate pairs: {uniq_coords}")
+
+    records = {x._id: asdict(x) for x in final_listings}
+
+    if args.changes:
+        prev_index = load_hash_index(args.output) or ([], {})
+        cur_index = (list(LISTING_FIELDS), build_hash_index(records, LISTING_FIELDS))
+        with previous_snapshot(args.output) as prev_records:
+            counts = write_changes(args.changes, diff_snapshots(prev_index, cur_index, records, prev_records))
+        log(f"🔁 Changes: +{counts['insert']} ~{counts['update']} -{counts['remove']} -> {args.changes}")
+
+    write_snapshot(args.output, list(records.values()))
+    if args.changes:
+        save_hash_index(hash_index_path(args.output), *cur_index)
+    else:
+        # a sidecar left by an earlier --changes run would no longer describe the snapshot
+        hash_index_path(args.output).unlink(missing_ok=True)
+
+    if args.search_index:
+        idx = TextIndex(args.search_index)
+        c = idx.sync(records.values())
+        idx.save()
+        log(f"🔎 Search index: +{c['added']} ~{c['updated']} -{c['removed']} ({len(idx)} docs) -> {args.search_index}")
+
+    if args.history:
+        with HistoryStore(args.history) as hs:
+            n = hs.append_run(list(records.values()))
+        log(f"🕰️  History: {n} change rows -> {args.history}")
+
+    if args.parquet:
+        n = write_parquet(list(records.values()), args.parquet)
+        log(f"🧱 Parquet: {n} rows -> {args.parquet}")
+
+    if route_stats is not None:
+        log(f"🚫 Blocked {route_stats['aborted']} image/font/media/tile requests")
+    if args.learn_endpoints:
+        endpoints.save()
+        log(f"🧠 Learned listing endpoints -> {args.endpoints}")
+
+    log(f"✅ Saved {len(final_listings)} ads to: {args.output}\n")
+    await page.close()
+    return len(final_listings)
+
+
+# -----------------------------
+# Daemon mode (warm browser, scheduled / on-demand crawls)
+# -----------------------------
+def process_tree_rss_mb(root_pid: Optional[int] = None) -> Optional[float]:
+    """RSS of all descendants of root_pid (browser + driver), from /proc. None where unavailable."""
+    root_pid = root_pid or os.getpid()
+    proc = Path("/proc")
+    if not proc.is_dir():
+        return None
 
-            clicked = await click_load_more(page)
-            if clicked:
-                await page.wait_for_timeout(2200)
+    children: Dict[int, List[int]] = {}
+    rss_pages: Dict[int, int] = {}
+    for d in proc.iterdir():
+        if not d.name.isdigit():
+            continue
+        try:
+            ppid = int((d / "stat").read_text().rsplit(")", 1)[1].split()[1])
+            rss_pages[int(d.name)] = int((d / "statm").read_text().split()[1])
+        except Exception:
+            continue
+        children.setdefault(ppid, []).append(int(d.name))
 
-            now = len(by_id)
-            if now >= args.max:
-                log(f"✅ Reached max={args.max}")
-                break
+    total = 0
+    stack = list(children.get(root_pid, []))
+    while stack:
+        pid = stack.pop()
+        total += rss_pages.get(pid, 0)
+        stack.extend(children.get(pid, []))
+    return total * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
 
-            delta = now - prev_count
-            if delta > 0:
-                log(f"📈 Step {step}/{args.scroll}: +{delta} ads (total: {now})")
-                stalls = 0
-                prev_count = now
-            else:
-                stalls += 1
-                log(f"⏳ Step {step}/{args.scroll}: no new ads (stall {stalls}/4)")
-                if stalls >= 4:
-                    break
 
-        if args.debug:
-            with open("debug-api-samples.json", "w", encoding="utf-8") as f:
-                json.dump(debug_samples, f, ensure_ascii=False, indent=2)
-            log("🧪 Saved debug-api-samples.json")
-
-        log(f"\n📦 Captured unique ads from XHR: {len(by_id)}")
-
-        # Hydrate missing coords
-        if hydrate_details and by_id:
-            missing = []
-            for _id, raw in by_id.items():
-                coords, _ = extract_coordinates(raw)
-                if coords is None:
-                    missing.append(_id)
-
-            if missing:
-                log(f"🧭 Missing coords for {len(missing)} ads. Hydrating via details...")
-                sem = asyncio.Semaphore(args.concurrency)
-
-                async def hydrate_one(_id: str):
-                    async with sem:
-                        full = await hydrate_from_details(browser, _id, user_agent)
-                        if full:
-                            prev = by_id.get(_id) or {}
-                            prev_has_geo = isinstance(prev.get("geometry"), dict) and isinstance(prev["geometry"].get("coordinates"), list)
-                            new_has_geo = isinstance(full.get("geometry"), dict) and isinstance(full["geometry"].get("coordinates"), list)
-                            if new_has_geo or not prev_has_geo:
-                                by_id[_id] = full
-
-                await asyncio.gather(*[hydrate_one(_id) for _id in missing])
-                log("✅ Details hydration done.")
-            else:
-                log("✅ All captured ads already have coords.")
+class ScraperDaemon:
+    """
+    Keeps Chromium and a pre-loaded discovery page alive between crawls.
+    Crawls run every --every minutes and/or on demand via the control API
+    (--control host:port or unix:/path):
+      GET  /status            daemon + last crawl summary
+      POST /crawl[?wait=1]    start a crawl (202), or run it and return the result
+      POST /stop              finish the current crawl and exit
+    The browser is relaunched after --recycle-crawls crawls or when its process
+    tree grows past --recycle-mb.
+    """
 
-        # Transform
-        final_listings = []
-        for _id, raw in by_id.items():
-            if normalize_id(raw) is None:
-                raw = {**raw, "_id": _id}
-            final_listings.append(to_scraped_listing(raw))
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.endpoints = EndpointFilter(args.endpoints, learn=args.learn_endpoints)
+        self.route_stats: Optional[Dict[str, int]] = None if args.no_block else {"aborted": 0}
+        self.p = None
+        self.browser: Optional[Browser] = None
+        self.warm_task: Optional[asyncio.Task] = None
+        self.warm_at = 0.0
+        self.lock = asyncio.Lock()
+        self.stopping = asyncio.Event()
+        self.background: set = set()
+        self.crawls_on_browser = 0
+        self.status: Dict[str, Any] = {"state": "starting", "crawls": 0, "browsers": 0, "last": None}
+
+    async def run(self) -> None:
+        async with async_playwright() as p:
+            self.p = p
+            await self.launch()
+            server = await self.start_control_server()
+            ticker = asyncio.create_task(self.schedule())
+            self.status["state"] = "idle"
+            log(f"🛰️  Daemon ready: control={self.args.control} every={self.args.every}min")
+            try:
+                await self.stopping.wait()
+                async with self.lock:
+                    pass  # let a running crawl finish
+            finally:
+                ticker.cancel()
+                server.close()
+                await server.wait_closed()
+                await self.browser.close()
+        log("👋 Daemon stopped")
+
+    async def launch(self) -> None:
+        self.browser = await self.p.chromium.launch(headless=not self.args.headful)
+        self.crawls_on_browser = 0
+        self.status["browsers"] += 1
+        self.prewarm()
+
+    def prewarm(self) -> None:
+        self.warm_at = time.monotonic()
+        self.warm_task = asyncio.create_task(
+            open_discovery_page(self.browser, self.args.url, self.endpoints, self.route_stats)
+        )
 
-        final_listings = final_listings[: args.max]
+    async def refresh_if_stale(self) -> None:
+        # a page that loaded long ago holds an old initial feed; replace it
+        if time.monotonic() - self.warm_at < self.args.warm_max_age:
+            return
+        old = self.warm_task
+        self.prewarm()
+        try:
+            await (await old).page.close()
+        except Exception:
+            pass
 
-        uniq_coords = len({",".join(map(str, x.geometry["coordinates"])) for x in final_listings})
-        log(f"📍 Unique coordinate pairs: {uniq_coords}")
+    async def take_warm_page(self) -> WarmPage:
+        try:
+            return await self.warm_task
+        except Exception:
+            self.prewarm()
+            return await self.warm_task
+
+    async def run_crawl(self) -> Dict[str, Any]:
+        async with self.lock:
+            started = time.monotonic()
+            self.status["state"] = "crawling"
+            result: Dict[str, Any] = {"ok": False}
+            try:
+                await self.refresh_if_stale()
+                warm = await self.take_warm_page()
+                try:
+                    n = await crawl(self.args, self.p, self.browser, warm, self.endpoints, self.route_stats)
+                    result = {"ok": True, "ads": n}
+                except Exception as e:
+                    result = {"ok": False, "error": repr(e)}
+                    try:
+                        await warm.page.close()
+                    except Exception:
+                        pass
+                self.crawls_on_browser += 1
+                await self.recycle_or_prewarm()
+            except Exception as e:
+                # prewarm/relaunch failures: report them like a failed crawl
+                result.update(ok=False, error=repr(e))
+            finally:
+                self.status["state"] = "idle"
+            result["seconds"] = round(time.monotonic() - started, 1)
+            result["finishedAt"] = datetime.now(timezone.utc).isoformat(timespec="seconds")
+            self.status["crawls"] += 1
+            self.status["last"] = result
+            if not result["ok"]:
+                log(f"⚠️  Crawl failed: {result['error']}")
+            return result
+
+    async def recycle_or_prewarm(self) -> None:
+        rss = process_tree_rss_mb()
+        too_big = rss is not None and rss >= self.args.recycle_mb
+        if too_big or self.crawls_on_browser >= self.args.recycle_crawls:
+            log(f"♻️  Recycling browser (crawls={self.crawls_on_browser}, rss={rss and round(rss)}MB)")
+            await self.browser.close()
+            await self.launch()
+        else:
+            self.prewarm()
+
+    async def schedule(self) -> None:
+        if self.args.every <= 0:
+            return
+        period = self.args.every * 60
+        lead = min(30.0, period / 2)
+        while True:
+            try:
+                await self.run_crawl()
+            except Exception as e:
+                # keep the schedule alive and retry next period
+                log(f"⚠️  Scheduled crawl failed: {e!r}")
+            await asyncio.sleep(period - lead)
+            async with self.lock:  # never swap the warm page out from under a running crawl
+                await self.refresh_if_stale()  # so the next crawl starts on a fresh, settled page
+            await asyncio.sleep(lead)
+
+    async def start_control_server(self):
+        ctl = self.args.control
+        if ctl.startswith("unix:"):
+            return await asyncio.start_unix_server(self.handle_client, path=ctl[len("unix:"):])
+        host, _, port = ctl.rpartition(":")
+        return await asyncio.start_server(self.handle_client, host or "127.0.0.1", int(port))
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass  # headers (and any body) are ignored
+            method, target = (request_line + ["", ""])[:2]
+            u = urlsplit(target)
+
+            try:
+                if method == "GET" and u.path == "/status":
+                    code, body = 200, {**self.status, "rssMb": process_tree_rss_mb()}
+                elif method == "POST" and u.path == "/crawl":
+                    if self.lock.locked():
+                        code, body = 409, {"error": "crawl already running"}
+                    elif "wait=1" in u.query:
+                        body = await self.run_crawl()
+                        code = 200 if body["ok"] else 500
+                    else:
+                        task = asyncio.create_task(self.run_crawl())
+                        self.background.add(task)
+                        task.add_done_callback(self.background.discard)
+                        code, body = 202, {"accepted": True}
+                elif method == "POST" and u.path == "/stop":
+                    self.stopping.set()
+                    code, body = 200, {"stopping": True}
+                else:
+                    code, body = 404, {"error": "not found"}
+            except Exception as e:
+                code, body = 500, {"error": repr(e)}
+
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            head = (
+                f"HTTP/1.1 {code} {HTTPStatus(code).phrase}\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\nConnection: close\r\n\r\n"
+            )
+            writer.write(head.encode("latin-1") + data)
+            await writer.drain()
+        except Exception:
+            pass
+        finally:
+            writer.close()
+
+
+async def main():
+    args = parse_args()
+    if args.lookup:
+        with SnapshotReader(args.output) as snap:
+            for _id in args.lookup:
+                print(json.dumps(snap.get(_id), ensure_ascii=False, indent=2))
+        return
+    if args.search:
+        with TextSearcher(args.search_index or "search-index") as idx:
+            for _id in idx.search(args.search):
+                print(_id)
+        return
+    if args.history_of:
+        with HistoryStore(args.history or "listing-history") as hs:
+            out = {
+                "history": hs.history(args.history_of),
+                "priceChanges": hs.price_changes(args.history_of),
+                "daysOnMarket": hs.days_on_market(args.history_of),
+                "viewsPerDay": hs.view_velocity(args.history_of),
+            }
+        print(json.dumps(out, ensure_ascii=False, indent=2))
+        return
+    if args.daemon:
+        await ScraperDaemon(args).run()
+        return
+
+    log("\n🕷️  elminassa scraper (Python v2)")
+    log(f"URL: {args.url}")
+    log(f"Output: {args.output}")
+    log(f"max={args.max} scroll={args.scroll} details={'OFF' if args.no_details else 'ON'} concurrency={args.concurrency}\n")
 
-        out = {"collection": [asdict(x) for x in final_listings]}
-        with open(args.output, "w", encoding="utf-8") as f:
-            json.dump(out, f, ensure_ascii=False, indent=2)
+    endpoints = EndpointFilter(args.endpoints, learn=args.learn_endpoints)
+    route_stats: Optional[Dict[str, int]] = None if args.no_block else {"aborted": 0}
 
-        log(f"✅ Saved {len(final_listings)} ads to: {args.output}\n")
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=not args.headful)
+        warm = await open_discovery_page(browser, args.url, endpoints, route_stats)
+        await crawl(args, p, browser, warm, endpoints, route_stats)
         await browser.close()
 
 
@@ -1,10 +1,15 @@
 import asyncio
 import argparse
 import hashlib
+import itertools
 import json
+import math
 import re
+import time
+from collections import Counter
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
 
 from playwright.async_api import async_playwright, Page, Browser
 
@@ -58,11 +63,28 @@ def normalize_id(o: Dict[str, Any]) -> Optional[str]:
     return None
 
 
+def merge_key(x: Any) -> str:
+    return x if isinstance(x, str) else json.dumps(x, sort_keys=True, default=str)
+
+
+def is_coord_pair(x: Any) -> bool:
+    return isinstance(x, list) and len(x) == 2 and all(
+        isinstance(v, (int, float)) and not isinstance(v, bool) for v in x
+    )
+
+
+def valid_coord_pair(x: Any) -> bool:
+    # [0, 0] is a placeholder, not a location
+    return is_coord_pair(x) and any(v != 0 for v in x) and all(math.isfinite(v) and abs(v) <= 180 for v in x)
+
+
 def deep_merge(a: Any, b: Any) -> Any:
     """
     Merge b into a, preferring non-empty values from b.
     - dict: recursive merge
-    - list: concatenate unique-ish (keeps order)
+    - two coordinate pairs: prefer b, unless it's [0, 0] or out of range
+    - list: concatenate unique (keeps order), so re-merging the same
+      subPolygon doesn't duplicate its vertices
     - scalars: prefer b if it's "meaningful"
     """
     if isinstance(a, dict) and isinstance(b, dict):
@@ -73,16 +95,16 @@ def deep_merge(a: Any, b: Any) -> Any:
         return out
 
     if isinstance(a, list) and isinstance(b, list):
+        if is_coord_pair(a) and is_coord_pair(b):
+            return b if valid_coord_pair(b) else a
         out = list(a)
-        # Avoid duplicates for strings; keep other items
-        seen = set(x for x in out if isinstance(x, str))
+        # Avoid duplicates: strings by value, other items by their JSON form
+        seen = set(merge_key(x) for x in out)
         for x in b:
-            if isinstance(x, str):
-                if x not in seen:
-                    out.append(x)
-                    seen.add(x)
-            else:
+            k = merge_key(x)
+            if k not in seen:
                 out.append(x)
+                seen.add(k)
         return out
 
     # Prefer b if it's not empty / not None / not "" / not 0-0 coords etc.
@@ -181,37 +203,246 @@ async def click_load_more(page: Page) -> bool:
     )
 
 
-async def run_pool(items: List[str], concurrency: int, fn):
-    sem = asyncio.Semaphore(concurrency)
-    results = []
+# -----------------------------
+# Request routing (network filtering)
+# -----------------------------
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media"}
+JSON_RESOURCE_TYPES = {"xhr", "fetch"}
+TILE_URL_RE = re.compile(
+    r"/tiles?/|/\d+/\d+/\d+(@2x)?\.(png|jpe?g|webp|pbf|mvt)\b|\.(pbf|mvt)(\?|$)|"
+    r"tile\.openstreetmap\.org|basemaps\.cartocdn\.com|api\.mapbox\.com/(styles|v4)/|"
+    r"maps\.googleapis\.com/maps/vt|mt\d\.google\.com",
+    re.I,
+)
+ID_SEGMENT_RE = re.compile(r"^([0-9a-f]{24}|[0-9a-f-]{32,36}|\d+)$", re.I)
+
+
+def should_block(resource_type: str, url: str) -> bool:
+    return resource_type in BLOCKED_RESOURCE_TYPES or bool(TILE_URL_RE.search(url))
+
 
-    async def wrapped(x):
-        async with sem:
-            return await fn(x)
+def endpoint_key(url: str) -> str:
+    # host + path, with id-like segments collapsed: api.x.com/adDetails/65ab.. -> api.x.com/adDetails/*
+    u = urlsplit(url)
+    segs = ["*" if ID_SEGMENT_RE.match(seg) else seg for seg in u.path.split("/")]
+    return u.netloc + "/".join(segs)
 
-    tasks = [asyncio.create_task(wrapped(x)) for x in items]
-    for t in tasks:
-        results.append(await t)
-    return results
+
+class EndpointFilter:
+    """
+    Decides which XHR/fetch bodies are worth buffering.
+    Endpoints are tracked per scope ("discovery", "details"); a scope with no
+    known endpoints buffers everything, as does learning mode. So does a scope
+    whose known endpoints yielded nothing on a settled page (see missed()).
+    """
+
+    def __init__(self, path: str, learn: bool = False):
+        self.path = Path(path)
+        self.learn = learn
+        self.known: Dict[str, Dict[str, int]] = {}
+        if self.path.exists():
+            try:
+                self.known = json.loads(self.path.read_text(encoding="utf-8"))
+            except Exception:
+                self.known = {}
+        self.hits: Dict[str, Dict[str, int]] = {}
+        self.fallback: set = set()
+
+    def wants_body(self, scope: str, resource_type: str, url: str) -> bool:
+        if resource_type not in JSON_RESOURCE_TYPES:
+            return False
+        known = self.known.get(scope)
+        return self.learn or not known or scope in self.fallback or endpoint_key(url) in known
+
+    def missed(self, scope: str, captured: int) -> bool:
+        """
+        Call once a page has settled. If the known endpoints of `scope` gave no
+        listings (API moved, or the file was learned by another scraper), buffer
+        every XHR/fetch for that scope from now on. Returns True when the
+        fallback was just switched on, i.e. the page is worth reloading.
+        """
+        if captured or self.learn or not self.known.get(scope) or scope in self.fallback:
+            return False
+        self.fallback.add(scope)
+        print(f"⚠️  No listings from known {scope} endpoints in {self.path}; buffering all XHR/fetch (re-learn with --learn-endpoints)")
+        return True
+
+    def record(self, scope: str, url: str, n_hits: int) -> None:
+        if n_hits:
+            seen = self.hits.setdefault(scope, {})
+            key = endpoint_key(url)
+            seen[key] = seen.get(key, 0) + n_hits
+
+    def save(self) -> None:
+        if not self.learn:
+            return
+        merged = {k: dict(v) for k, v in self.known.items()}
+        for scope, seen in self.hits.items():
+            dst = merged.setdefault(scope, {})
+            for k, n in seen.items():
+                dst[k] = dst.get(k, 0) + n
+        self.path.write_text(json.dumps(merged, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+async def install_routing(page: Page, stats: Dict[str, int]) -> None:
+    async def handle(route):
+        req = route.request
+        if should_block(req.resource_type, req.url):
+            stats["aborted"] = stats.get("aborted", 0) + 1
+            await route.abort()
+        else:
+            await route.continue_()
+
+    await page.route("**/*", handle)
+
+
+# -----------------------------
+# Pagination termination
+# -----------------------------
+TOTAL_KEYS = ("total", "totalCount", "total_count", "totalDocs", "totalResults", "totalItems", "totalElements")
+MORE_KEYS = ("hasMore", "has_more", "hasNextPage", "has_next_page", "hasNext")
+CURSOR_KEYS = ("nextCursor", "next_cursor", "nextPage", "next_page")
+HINT_CONTAINERS = ("meta", "pagination", "pageInfo", "paging", "data")
+
+
+def extract_feed_hints(payload: Any, n_hits: int) -> Dict[str, Any]:
+    """
+    Reads server-side pagination fields from a listing payload (top level or one
+    container deep). Returns {"total": int} and/or {"has_more": bool}.
+    A total is only trusted when it exceeds the payload's own `n_hits`; a
+    per-page count looks the same as a feed total otherwise.
+    """
+    hints: Dict[str, Any] = {}
+    if not isinstance(payload, dict):
+        return hints
+    nodes = [payload] + [payload[k] for k in HINT_CONTAINERS if isinstance(payload.get(k), dict)]
+
+    for node in nodes:
+        for k in TOTAL_KEYS:
+            v = node.get(k)
+            if isinstance(v, int) and not isinstance(v, bool) and v > n_hits:
+                hints.setdefault("total", v)
+        for k in MORE_KEYS:
+            if isinstance(node.get(k), bool):
+                hints.setdefault("has_more", node[k])
+        for k in CURSOR_KEYS:
+            if k in node and not isinstance(node[k], (dict, list)):
+                v = node[k]  # a cursor of 0 is still a cursor
+                hints.setdefault("has_more", not (v is None or v is False or v == ""))
+        page, pages = node.get("page"), node.get("totalPages") or node.get("pages")
+        if isinstance(page, int) and isinstance(pages, int) and pages > 0:
+            hints.setdefault("has_more", page < pages)
+    return hints
+
+
+class FeedTracker:
+    """
+    Decides when the scroll feed is exhausted.
+    1) server hints: total reached, or hasMore/cursor says no more pages
+    2) otherwise a growth model: once a step yields a partial page (fewer new IDs
+       than the usual page size) and we have stalled longer than any gap the feed
+       recovered from before, stop
+    Steps with listing requests still in flight don't count as stalls (slow feed).
+    `max_stall` stays the hard upper bound.
+    """
+
+    def __init__(self, max_stall: int):
+        self.max_stall = max_stall
+        self.total: Optional[int] = None
+        self.has_more: Optional[bool] = None
+        self.deltas: List[int] = []
+        self.max_gap = 0
+        self.stalls = 0
+        self.slow_waits = 0
+        self.pending = 0
+
+    def watch(self, page: Page) -> None:
+        def started(req):
+            if req.resource_type in JSON_RESOURCE_TYPES:
+                self.pending += 1
+
+        def done(req):
+            if req.resource_type in JSON_RESOURCE_TYPES:
+                self.pending = max(0, self.pending - 1)
+
+        page.on("request", started)
+        page.on("requestfinished", done)
+        page.on("requestfailed", done)
+
+    def observe(self, payload: Any, n_hits: int) -> None:
+        hints = extract_feed_hints(payload, n_hits)
+        if "total" in hints:
+            self.total = max(self.total or 0, hints["total"])
+        if "has_more" in hints:
+            self.has_more = hints["has_more"]
+
+    @property
+    def idle(self) -> int:
+        """No-growth steps since the last growth, slow waits included."""
+        return self.stalls + self.slow_waits
+
+    def last_page_partial(self) -> bool:
+        if len(self.deltas) < 2:
+            return False
+        page_size = Counter(self.deltas[:-1]).most_common(1)[0][0]
+        return self.deltas[-1] < page_size
+
+    def step(self, delta: int, count: int) -> Optional[str]:
+        """Returns a stop reason, or None to keep scrolling."""
+        if self.total and count >= self.total:
+            return f"server total reached ({count}/{self.total})"
+
+        if delta > 0:
+            self.max_gap = max(self.max_gap, self.stalls)
+            self.stalls = self.slow_waits = 0
+            self.deltas.append(delta)
+            return None
+
+        # slow waits and stalls share the max_stall budget
+        if self.pending > 0 and self.idle + 1 < self.max_stall:
+            self.slow_waits += 1
+            return None
+
+        self.stalls += 1
+        if self.has_more is False:
+            return "server reports no more pages"
+        if self.idle >= self.max_stall:
+            return f"no growth for {self.idle} steps"
+        server_says_more = self.has_more is True or (self.total is not None and count < self.total)
+        if not server_says_more and self.stalls > self.max_gap and self.last_page_partial():
+            return "last page was partial"
+        return None
 
 
 # -----------------------------
 # Detail hydration
 # -----------------------------
-async def hydrate_from_details(browser: Browser, ad_id: str, user_agent: str, out_dir: Path) -> Optional[Dict[str, Any]]:
+async def hydrate_from_details(
+    browser: Browser,
+    ad_id: str,
+    user_agent: str,
+    out_dir: Path,
+    endpoints: Optional[EndpointFilter] = None,
+    route_stats: Optional[Dict[str, int]] = None,
+) -> Optional[Dict[str, Any]]:
     """
     Opens /adDetails/<id> and uses the same "response discovery" method to capture JSON.
     Returns the best listing object for that id (prefer one with geometry).
     """
     url = f"https://elminassa.com/adDetails/{ad_id}"
     page = await browser.new_page(viewport={"width": 1400, "height": 900}, user_agent=user_agent)
+    if route_stats is not None:
+        await install_routing(page, route_stats)
 
     found: List[Dict[str, Any]] = []
     url_count: Dict[str, int] = {}
 
     async def on_response(resp):
         try:
-            if resp.request.resource_type not in ("xhr", "fetch"):
+            if endpoints is not None:
+                if not endpoints.wants_body("details", resp.request.resource_type, resp.url):
+                    return
+            elif resp.request.resource_type not in JSON_RESOURCE_TYPES:
                 return
             data = await try_read_json(resp)
             if data is None:
@@ -224,6 +455,8 @@ async def hydrate_from_details(browser: Browser, ad_id: str, user_agent: str, ou
             fname.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
 
             hits = collect_listings_deep(data)
+            if endpoints is not None:
+                endpoints.record("details", resp.url, len(hits))
             for h in hits:
                 hid = normalize_id(h)
                 if hid == ad_id:
@@ -236,6 +469,9 @@ async def hydrate_from_details(browser: Browser, ad_id: str, user_agent: str, ou
     try:
         await page.goto(url, wait_until="domcontentloaded", timeout=60000)
         await page.wait_for_timeout(3500)
+        if endpoints is not None and endpoints.missed("details", len(found)):
+            await page.reload(wait_until="domcontentloaded", timeout=60000)
+            await page.wait_for_timeout(3500)
 
         # Also check common window globals (sometimes injected state)
         window_candidates = await page.evaluate(
@@ -268,6 +504,113 @@ async def hydrate_from_details(browser: Browser, ad_id: str, user_agent: str, ou
         await page.close()
 
 
+# -----------------------------
+# Pipelined hydration
+# -----------------------------
+def raw_visit_count(item: Dict[str, Any]) -> int:
+    v = item.get("visitCount") or item.get("visit_count") or item.get("views") or 0
+    try:
+        return int(v)
+    except Exception:
+        return 0
+
+
+def hydration_priority(raw: Dict[str, Any], is_new: bool, was_deferred: bool) -> Tuple[int, int, int]:
+    """Lower sorts first: new ads, then ads deferred by the last run, then by visitCount, missing coords first."""
+    tier = 0 if is_new else 1 if was_deferred else 2
+    missing = extract_coordinates(raw)[0] is None
+    return (tier, -raw_visit_count(raw), 0 if missing else 1)
+
+
+def load_previous_ids(output: str) -> set:
+    try:
+        collection = json.loads(Path(output).read_text(encoding="utf-8")).get("collection") or []
+    except Exception:
+        return set()
+    return {normalize_id(x) for x in collection if isinstance(x, dict)} - {None}
+
+
+def deferred_path(output: str) -> Path:
+    return Path(f"{output}.deferred.json")
+
+
+def load_deferred(output: str) -> set:
+    try:
+        return set(json.loads(deferred_path(output).read_text(encoding="utf-8")))
+    except Exception:
+        return set()
+
+
+def save_deferred(output: str, ids: List[str]) -> None:
+    deferred_path(output).write_text(json.dumps(ids), encoding="utf-8")
+
+
+class HydrationPipeline:
+    """
+    Priority queue between discovery and detail hydration.
+    Discovery pushes IDs as soon as they are seen; `workers` tasks drain the
+    best-priority ID first while scrolling continues. The scroll loop waits
+    while the backlog exceeds `maxsize`. Once `deadline` (time.monotonic())
+    passes, unfinished IDs are collected in `deferred` instead of hydrated.
+    """
+
+    def __init__(self, fn, workers: int, maxsize: int, deadline: Optional[float] = None):
+        self.fn = fn
+        self.queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self.maxsize = maxsize
+        self.workers = workers
+        self.deadline = deadline
+        self.tasks: List[asyncio.Task] = []
+        self.seen: set = set()
+        self.seq = itertools.count()
+        self.deferred: List[str] = []
+        self.done = 0
+
+    def start(self) -> None:
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def remaining(self) -> Optional[float]:
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def expired(self) -> bool:
+        left = self.remaining()
+        return left is not None and left <= 0
+
+    async def put(self, _id: str, priority: Tuple = ()) -> None:
+        if _id in self.seen:
+            return
+        self.seen.add(_id)
+        self.queue.put_nowait((priority, next(self.seq), _id))
+
+    async def wait_for_room(self) -> None:
+        # backpressure for the scroll loop
+        while self.queue.qsize() >= self.maxsize and not self.expired():
+            await asyncio.sleep(0.25)
+
+    async def _worker(self) -> None:
+        while True:
+            _, _, _id = await self.queue.get()
+            try:
+                if _id is None:
+                    return
+                if self.expired():
+                    self.deferred.append(_id)
+                    continue
+                await asyncio.wait_for(self.fn(_id), self.remaining())
+                self.done += 1
+            except asyncio.TimeoutError:
+                self.deferred.append(_id)
+            except Exception:
+                pass
+            finally:
+                self.queue.task_done()
+
+    async def close(self) -> None:
+        for _ in self.tasks:
+            self.queue.put_nowait(((math.inf,), next(self.seq), None))
+        await asyncio.gather(*self.tasks)
+
+
 # -----------------------------
 # Main discovery + extraction
 # -----------------------------
@@ -278,11 +621,15 @@ async def main():
     ap.add_argument("--output", default="scraped-elminassa-data.full.json")
     ap.add_argument("--scroll", type=int, default=80)
     ap.add_argument("--max", type=int, default=3000)
-    ap.add_argument("--stall", type=int, default=4, help="stop after this many no-growth steps")
+    ap.add_argument("--stall", type=int, default=4, help="hard stop after this many no-growth steps")
     ap.add_argument("--details", action="store_true", help="hydrate all ads via /adDetails/<id>")
     ap.add_argument("--concurrency", type=int, default=6)
+    ap.add_argument("--deadline", type=float, default=0, help="hydration time budget in seconds; unhydrated ads roll over to the next run (0 = none)")
     ap.add_argument("--headful", action="store_true")
     ap.add_argument("--debug", action="store_true")
+    ap.add_argument("--no-block", action="store_true", help="let the browser download images/fonts/media/map tiles")
+    ap.add_argument("--endpoints", default="listing-endpoints.json", help="known listing endpoints (written by --learn-endpoints)")
+    ap.add_argument("--learn-endpoints", action="store_true", help="buffer every XHR and record endpoints that yield listings")
     args, unknown = ap.parse_known_args() # Use parse_known_args to ignore Colab's arguments
 
     out_dir = Path(args.out)
@@ -293,16 +640,39 @@ async def main():
     # Store best raw listing object by id
     by_id: Dict[str, Dict[str, Any]] = {}
 
+    # Hydration order/budget: new ads first, leftovers of the last run next
+    deadline = time.monotonic() + args.deadline if args.deadline > 0 else None
+    prev_ids = load_previous_ids(args.output)
+    was_deferred = load_deferred(args.output)
+
     # To avoid overwriting same URL file
     url_count: Dict[str, int] = {}
 
+    # Only buffer bodies from endpoints known to carry listings; abort heavy assets
+    endpoints = EndpointFilter(args.endpoints, learn=args.learn_endpoints)
+    route_stats: Optional[Dict[str, int]] = None if args.no_block else {"aborted": 0}
+    feed = FeedTracker(args.stall)
+
     async with async_playwright() as p:
         browser = await p.chromium.launch(headless=not args.headful)
         page = await browser.new_page(viewport={"width": 1920, "height": 1080}, user_agent=user_agent)
+        if route_stats is not None:
+            await install_routing(page, route_stats)
+
+        # Detail hydration runs concurrently with scrolling (fed from on_response)
+        async def hydrate_one(_id: str):
+            full = await hydrate_from_details(browser, _id, user_agent, out_dir, endpoints, route_stats)
+            if full:
+                by_id[_id] = deep_merge(by_id.get(_id, {}), full)
+
+        pipeline = HydrationPipeline(hydrate_one, args.concurrency, maxsize=4 * args.concurrency, deadline=deadline)
+        if args.details:
+            pipeline.start()
 
         async def on_response(resp):
             try:
-                # Keep the "discovery method": capture JSON from all responses
+                if not endpoints.wants_body("discovery", resp.request.resource_type, resp.url):
+                    return
                 data = await try_read_json(resp)
                 if data is None:
                     # still log XHR/fetch in debug mode
@@ -322,6 +692,9 @@ async def main():
 
                 # Extract listings from this JSON and merge into by_id
                 hits = collect_listings_deep(data)
+                endpoints.record("discovery", u, len(hits))
+                if hits:
+                    feed.observe(data, len(hits))
                 for h in hits:
                     _id = normalize_id(h)
                     if not _id:
@@ -329,6 +702,8 @@ async def main():
 
                     if _id not in by_id:
                         by_id[_id] = h
+                        if args.details:
+                            await pipeline.put(_id, hydration_priority(h, _id not in prev_ids, _id in was_deferred))
                     else:
                         # merge payloads, prefer richer objects
                         by_id[_id] = deep_merge(by_id[_id], h)
@@ -337,15 +712,20 @@ async def main():
                 return
 
         page.on("response", on_response)
+        feed.watch(page)
 
         print(f"Opening: {args.url}")
         await page.goto(args.url, wait_until="domcontentloaded", timeout=60000)
         await page.wait_for_timeout(6000)
+        if endpoints.missed("discovery", len(by_id)):
+            await page.reload(wait_until="domcontentloaded", timeout=60000)
+            await page.wait_for_timeout(6000)
 
         prev = 0
-        stalls = 0
 
         for step in range(1, args.scroll + 1):
+            await pipeline.wait_for_room()
+
             # scroll to trigger lazy loads
             await page.mouse.wheel(0, 2800)
             await page.wait_for_timeout(1400)
@@ -362,30 +742,33 @@ async def main():
                 print(f"✅ Reached max={args.max}")
                 break
 
+            stop = feed.step(delta, now)
             if delta > 0:
                 print(f"📈 Step {step}/{args.scroll}: +{delta} ads (total={now})")
-                stalls = 0
                 prev = now
             else:
-                stalls += 1
-                print(f"⏳ Step {step}/{args.scroll}: no new ads (stall {stalls}/{args.stall})")
-                if stalls >= args.stall:
-                    break
+                print(f"⏳ Step {step}/{args.scroll}: no new ads (stall {feed.idle}/{args.stall}, pending={feed.pending})")
+            if stop:
+                print(f"🏁 Feed exhausted: {stop}")
+                break
 
         print(f"\n📦 Unique ads captured from discovery JSON: {len(by_id)}")
 
         # Optional: hydrate ALL ads (this is the closest to "extract everything")
-        if args.details and by_id:
-            ids = list(by_id.keys())
-            print(f"🧩 Hydrating {len(ids)} ads via /adDetails/<id> (concurrency={args.concurrency}) ...")
-
-            async def hydrate_one(_id: str):
-                full = await hydrate_from_details(browser, _id, user_agent, out_dir)
-                if full:
-                    by_id[_id] = deep_merge(by_id.get(_id, {}), full)
-
-            await run_pool(ids, args.concurrency, hydrate_one)
+        if args.details:
+            print(f"🧩 Hydrating {len(pipeline.seen)} ads via /adDetails/<id> (concurrency={args.concurrency}, {pipeline.done} done during discovery) ...")
+        await pipeline.close()
+        if args.details:
             print("✅ Hydration done.")
+            if pipeline.deferred:
+                print(f"⏰ Deferred {len(pipeline.deferred)} ads to the next run")
+            save_deferred(args.output, pipeline.deferred)
+
+        if route_stats is not None:
+            print(f"🚫 Blocked {route_stats['aborted']} image/font/media/tile requests")
+        if args.learn_endpoints:
+            endpoints.save()
+            print(f"🧠 Learned listing endpoints -> {args.endpoints}")
 
         await browser.close()
 
@@ -412,6 +795,10 @@ async def main():
 
         collection.append(raw)
 
+    if not collection and prev_ids:
+        print(f"⚠️  Captured no ads; keeping the previous snapshot of {len(prev_ids)} ads in {args.output}")
+        return
+
     out = {"collection": collection}
     Path(args.output).write_text(json.dumps(out, ensure_ascii=False, indent=2), encoding="utf-8")
 